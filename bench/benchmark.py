@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+# * benchmark.py
+
+# Runs the scripts against fake MPD servers with synthetic libraries
+# and reports, for each case, the wall time, the number of round trips
+# and commands the server saw, the bytes it sent, and the script's
+# peak memory.
+
+# ** Imports
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakempd
+
+# ** Constants
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEARCH_ADD = os.path.join(SCRIPT_DIR, 'mpd-search-add.py')
+TRIM = os.path.join(SCRIPT_DIR, 'trim-mpd-playlist.py')
+
+# Each case: the script, its arguments, and how many tracks to put in
+# the queue first (None for the size of the library)
+CASES = [
+    ('search', SEARCH_ADD, ['-p', '-a', 'artist 1'], 0),
+    ('fill', SEARCH_ADD, ['-p', '-d', '600', '-g', 'rock'], 0),
+    ('add', SEARCH_ADD, ['-d', '600', '-g', 'rock'], 0),
+    ('trim', TRIM, ['600'], None),
+]
+
+# ** Functions
+
+
+def runCase(server, script, args, queueSize, devnull):
+    '''Runs script with args against server and returns a dict of
+    measurements.'''
+
+    daemon = server.daemon
+    daemon.setQueue(xrange(queueSize))
+    daemon.resetCounters()
+
+    command = [sys.executable, script, '-s', server.address] + args
+
+    start = time.time()
+    process = subprocess.Popen(command, stdout=devnull)
+    pid, status, usage = os.wait4(process.pid, 0)
+    wall = time.time() - start
+
+    # Popen doesn't know the process was reaped
+    process.returncode = os.WEXITSTATUS(status)
+
+    return {'status': process.returncode,
+            'wall': wall,
+            'roundTrips': daemon.roundTrips,
+            'commands': daemon.commands,
+            'bytesSent': daemon.bytesSent,
+            'maxRSS': usage.ru_maxrss}  # KiB on Linux
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the scripts against fake MPD servers')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+',
+                        default=[1000, 100000], metavar='TRACKS',
+                        help='Library sizes to run.  Default: 1000 100000')
+    parser.add_argument('-q', '--queue', type=int, metavar='TRACKS',
+                        help='Tracks in the queue for the trim case.  '
+                        'Default: the size of the library')
+    parser.add_argument('-c', '--cases', nargs='+',
+                        choices=[case[0] for case in CASES],
+                        default=[case[0] for case in CASES])
+    parser.add_argument('-l', '--latency', type=float, default=0,
+                        metavar='SECONDS',
+                        help="Delay before each of the server's responses")
+    parser.add_argument('-u', '--unix-socket', dest='unixSocket',
+                        action='store_true',
+                        help='Connect through a Unix socket instead of TCP')
+    parser.add_argument('-L', '--library-cache', dest='libraryCache',
+                        action='store_true',
+                        help='Run mpd-search-add.py with a library cache, '
+                        'built before measuring')
+    parser.add_argument('-V', '--protocol', dest='protocolVersion',
+                        default=fakempd.PROTOCOL_VERSION, metavar='VERSION',
+                        help='Protocol version the servers report.  Below '
+                        '0.24, mpd-search-add.py searches with a command '
+                        'list instead of a filter expression.  Default: %s'
+                        % fakempd.PROTOCOL_VERSION)
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='Run each case this many times and report '
+                        'the fastest.  Default: 1')
+    parser.add_argument('-j', '--json', action='store_true',
+                        help='Print one JSON object per result instead of '
+                        'a table')
+    args = parser.parse_args()
+
+    devnull = open(os.devnull, 'w')
+    tempDir = tempfile.mkdtemp()
+    if not args.json:
+        print '%-8s %-8s %6s %9s %8s %8s %10s %9s' % (
+            'tracks', 'case', 'status', 'wall (s)', 'trips', 'commands',
+            'sent (KB)', 'RSS (MB)')
+
+    for size in args.sizes:
+        server = fakempd.Server(
+            tracks=size, latency=args.latency,
+            protocolVersion=args.protocolVersion,
+            path=(os.path.join(tempDir, 'socket-%d' % size)
+                  if args.unixSocket else None)).start()
+
+        cacheArgs = []
+        if args.libraryCache:
+            cacheArgs = ['-L', os.path.join(tempDir, 'library-%d' % size)]
+            runCase(server, SEARCH_ADD, ['-p', '-a', 'artist 1'] + cacheArgs,
+                    0, devnull)
+
+        for name, script, scriptArgs, queueSize in CASES:
+            if name not in args.cases:
+                continue
+
+            if queueSize is None:
+                queueSize = args.queue if args.queue is not None else size
+            if script == SEARCH_ADD:
+                scriptArgs = scriptArgs + cacheArgs
+
+            result = min((runCase(server, script, scriptArgs, queueSize,
+                                  devnull)
+                          for i in xrange(args.repeat)),
+                         key=lambda result: result['wall'])
+            result.update(tracks=size, case=name)
+
+            if args.json:
+                print json.dumps(result, sort_keys=True)
+            else:
+                print '%-8d %-8s %6d %9.3f %8d %8d %10.1f %9.1f' % (
+                    size, name, result['status'], result['wall'],
+                    result['roundTrips'], result['commands'],
+                    result['bytesSent'] / 1024.0, result['maxRSS'] / 1024.0)
+            sys.stdout.flush()
+
+        server.stop()
+
+    shutil.rmtree(tempDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,977 @@
+#!/usr/bin/env python
+
+# * fakempd.py
+
+# A stand-in MPD server for benchmarking the scripts without a real
+# MPD.  It speaks enough of the protocol for them, serves a synthetic
+# library and queue, and can add latency to every response.  It can
+# run in-process, in a thread, or from the command line.
+
+# ** Imports
+import argparse
+import array
+import os
+import random
+import re
+import select
+import shlex
+import socket
+import SocketServer
+import threading
+import time
+
+# ** Constants
+PROTOCOL_VERSION = '0.24.0'
+FILTERS_VERSION = (0, 21)  # Filter expressions
+CONTAINS_VERSION = (0, 24)  # Their "contains" operator
+
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 5
+GENRES = ['Ambient', 'Blues', 'Classical', 'Country', 'Electronic', 'Folk',
+          'Hip-Hop', 'Jazz', 'Latin', 'Metal', 'Pop', 'Punk', 'Reggae',
+          'Rock', 'Soul', 'Soundtrack']
+
+SUBSYSTEMS = ['database', 'update', 'stored_playlist', 'playlist', 'player',
+              'mixer', 'output', 'options', 'sticker', 'subscription',
+              'message']
+
+TRACK_PATH_RE = re.compile(r'/track(\d+)\.mp3$')
+
+# ** Classes
+
+
+class ProtocolError(Exception):
+    '''An error to send to the client as an ACK.'''
+
+    def __init__(self, message, code=5):
+        super(ProtocolError, self).__init__(message)
+        self.code = code
+
+
+class Library(object):
+    '''A synthetic library of tracks.  Only each track's duration is
+    stored; its path and tags are generated from its index, so even a
+    library of millions of tracks is small.'''
+
+    tagNames = ['Artist', 'Album', 'Title', 'Genre']
+
+    def __init__(self, size, seed=0):
+        self.size = size
+
+        rand = random.Random(seed)
+        self.durations = array.array('H', (rand.randint(30, 600)
+                                           for i in xrange(size)))
+
+    def __len__(self):
+        return self.size
+
+    def find(self, path):
+        '''Returns the index of the track at path.'''
+
+        match = TRACK_PATH_RE.search(path)
+        if match:
+            index = int(match.group(1))
+            if index < self.size and self.path(index) == path:
+                return index
+
+        raise ProtocolError('No such song', code=50)
+
+    def path(self, index):
+        album = index // TRACKS_PER_ALBUM
+        artist = album // ALBUMS_PER_ARTIST
+
+        return 'artist%d/album%d/track%d.mp3' % (artist, album, index)
+
+    def tags(self, index):
+        '''Returns a list of (tag, value) for a track.'''
+
+        album = index // TRACKS_PER_ALBUM
+        artist = album // ALBUMS_PER_ARTIST
+
+        return [('Artist', 'Artist %d' % artist),
+                ('Album', 'Album %d' % album),
+                ('Title', 'Track %d' % index),
+                ('Genre', GENRES[index % len(GENRES)])]
+
+    def song(self, index):
+        '''Returns the lines describing a track.'''
+
+        duration = self.durations[index]
+        lines = ['file: %s' % self.path(index)]
+        lines.extend('%s: %s' % tag for tag in self.tags(index))
+        lines.append('Time: %d' % duration)
+        lines.append('duration: %d.000' % duration)
+
+        return lines
+
+    def matcher(self, args, exact=False, protocol=None):
+        '''Returns a function that tests a track index against find or
+        search arguments: either one filter expression, or TAG VALUE
+        pairs.  protocol is the (major, minor) version of the daemon,
+        which decides whether filter expressions and their operators
+        are understood; None means any.'''
+
+        if len(args) == 1:
+            if protocol is not None and protocol < FILTERS_VERSION:
+                raise ProtocolError('incorrect arguments', code=2)
+            return FilterParser(args[0], self, exact, protocol).parse()
+
+        if not args or len(args) % 2:
+            raise ProtocolError('incorrect arguments', code=2)
+
+        tests = [self.tagTest(tag, 'contains' if not exact else '==', value,
+                              caseSensitive=exact)
+                 for tag, value in zip(args[::2], args[1::2])]
+
+        return lambda index: all(test(index) for test in tests)
+
+    def tagTest(self, tag, operator, value, caseSensitive=False):
+        '''Returns a function that compares a tag of a track with value.'''
+
+        tag = tag.lower()
+        if not caseSensitive:
+            value = value.lower()
+
+        if tag in ['file', 'any']:
+            getValues = lambda index: ([self.path(index)]
+                                       + ([v for t, v in self.tags(index)]
+                                          if tag == 'any' else []))
+        elif tag.capitalize() in self.tagNames:
+            position = self.tagNames.index(tag.capitalize())
+            getValues = lambda index: [self.tags(index)[position][1]]
+        else:
+            getValues = lambda index: []
+
+        if operator == '==':
+            compare = lambda v: v == value
+        elif operator == '!=':
+            compare = lambda v: v != value
+        elif operator == 'contains':
+            compare = lambda v: value in v
+        else:
+            raise ProtocolError('Unknown filter operator: %s' % operator)
+
+        if caseSensitive:
+            return lambda index: any(compare(v) for v in getValues(index))
+
+        return lambda index: any(compare(v.lower()) for v in getValues(index))
+
+
+class FilterParser(object):
+    '''Parses an MPD filter expression into a function that tests a
+    track index.'''
+
+    def __init__(self, text, library, exact, protocol=None):
+        self.text = text
+        self.library = library
+        self.exact = exact
+        self.protocol = protocol
+        self.pos = 0
+
+    def parse(self):
+        result = self._expression()
+        self._skipSpace()
+        if self.pos != len(self.text):
+            raise ProtocolError('Unparsed garbage after expression')
+
+        return result
+
+    def _expect(self, c):
+        self._skipSpace()
+        if not self.text.startswith(c, self.pos):
+            raise ProtocolError("'%s' expected" % c)
+        self.pos += len(c)
+
+    def _expression(self):
+        self._expect('(')
+        self._skipSpace()
+
+        if self.text.startswith('!', self.pos):
+            self.pos += 1
+            inner = self._expression()
+            self._expect(')')
+            return lambda index: not inner(index)
+
+        if self.text.startswith('(', self.pos):
+            parts = [self._expression()]
+            while True:
+                self._skipSpace()
+                if self.text.startswith(')', self.pos):
+                    self.pos += 1
+                    return lambda index: all(part(index) for part in parts)
+                self._expect('AND')
+                parts.append(self._expression())
+
+        tag = self._word()
+        operator = self._word()
+        if (operator == 'contains' and self.protocol is not None
+                and self.protocol < CONTAINS_VERSION):
+            raise ProtocolError('Unknown filter operator: %s' % operator)
+        value = self._string()
+        self._expect(')')
+
+        return self.library.tagTest(tag, operator, value,
+                                    caseSensitive=self.exact)
+
+    def _skipSpace(self):
+        while self.pos < len(self.text) and self.text[self.pos] == ' ':
+            self.pos += 1
+
+    def _string(self):
+        self._skipSpace()
+        quote = self.text[self.pos:self.pos + 1]
+        if quote not in ['"', "'"]:
+            raise ProtocolError('Quoted string expected')
+        self.pos += 1
+
+        chars = []
+        while True:
+            if self.pos >= len(self.text):
+                raise ProtocolError('Closing quote not found')
+            c = self.text[self.pos]
+            self.pos += 1
+            if c == quote:
+                return ''.join(chars)
+            if c == '\\':
+                c = self.text[self.pos]
+                self.pos += 1
+            chars.append(c)
+
+    def _word(self):
+        self._skipSpace()
+        start = self.pos
+        while (self.pos < len(self.text)
+               and self.text[self.pos] not in ' ()'):
+            self.pos += 1
+
+        return self.text[start:self.pos]
+
+
+class Daemon(object):
+    '''The state shared by all connections: the library, the queue,
+    playback and statistics.'''
+
+    def __init__(self, library, queueSize=0, latency=0, commandLatency=None,
+                 protocolVersion=PROTOCOL_VERSION):
+        self.library = library
+        self.lock = threading.RLock()
+
+        # The version sent in the greeting, and as (major, minor) for
+        # deciding which search arguments are understood
+        self.protocolVersion = protocolVersion
+        self.protocol = tuple(int(n) for n in
+                              protocolVersion.split('.')[:2])
+
+        # Seconds to wait before each response, and extra seconds for
+        # each command by name
+        self.latency = latency
+        self.commandLatency = commandLatency or {}
+
+        self.startTime = time.time()
+        self.dbUpdate = int(self.startTime)
+        self.connections = set()
+        self.resetCounters()
+
+        self.queue = []  # (song ID, library index)
+        self.nextId = 1
+        self.version = 0
+        self.positionVersions = []  # Version each position last changed at
+
+        self.state = 'stop'
+        self.songId = None
+        self.elapsed = 0.0
+        self.playStart = None  # time.time() when elapsed was last set
+        self.options = dict((option, 0) for option in
+                            ['repeat', 'random', 'single', 'consume'])
+
+        self.playlists = {}  # Stored playlist name -> library indexes
+
+        self.setQueue(range(min(queueSize, len(library))))
+
+    def resetCounters(self):
+        '''Zeroes the command, round trip and byte counters.'''
+
+        self.commands = 0
+        self.roundTrips = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+
+    def changed(self, *subsystems):
+        '''Tells all connections that subsystems have changed.'''
+
+        for connection in list(self.connections):
+            connection.notify(subsystems)
+
+    def currentElapsed(self):
+        if self.state == 'play':
+            return self.elapsed + time.time() - self.playStart
+
+        return self.elapsed
+
+    def currentPosition(self):
+        ids = [songId for songId, index in self.queue]
+        if self.songId in ids:
+            return ids.index(self.songId)
+
+        return None
+
+    def queueChanged(self, start, removed=()):
+        '''Bumps the playlist version after the queue changed from
+        position start onwards, and stops playing if the current song
+        is among the removed entries.'''
+
+        self.version += 1
+        self.positionVersions[start:] = ([self.version]
+                                         * (len(self.queue) - start))
+
+        if any(songId == self.songId for songId, index in removed):
+            self.stop()
+
+        self.changed('playlist')
+
+    def setQueue(self, indexes):
+        '''Replaces the queue with tracks from the library.'''
+
+        with self.lock:
+            removed = self.queue
+            self.queue = []
+            for index in indexes:
+                self.queue.append((self.nextId, index))
+                self.nextId += 1
+            self.queueChanged(0, removed)
+
+    def startPlaying(self, songId, elapsed=0.0):
+        self.songId = songId
+        self.elapsed = elapsed
+        self.playStart = time.time()
+        self.state = 'play'
+        self.changed('player')
+
+    def stop(self):
+        self.state = 'stop'
+        self.songId = None
+        self.elapsed = 0.0
+        self.changed('player')
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    '''Handles one client connection.'''
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+
+        self.daemon = self.server.daemon
+        self.events = set()
+        self.eventsLock = threading.Lock()
+
+        with self.daemon.lock:
+            self.daemon.connections.add(self)
+
+    def finish(self):
+        with self.daemon.lock:
+            self.daemon.connections.discard(self)
+
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def handle(self):
+        self.send('OK MPD %s\n' % self.daemon.protocolVersion, roundTrip=False)
+
+        commandList = None
+        while True:
+            line = self.readLine()
+            if line is None or line == 'close':
+                return
+
+            if line in ['command_list_begin', 'command_list_ok_begin']:
+                commandList = (line, [])
+
+            elif line == 'command_list_end':
+                self.send(self.runCommandList(*commandList),
+                          commands=[c for c in commandList[1]])
+                commandList = None
+
+            elif commandList is not None:
+                commandList[1].append(line)
+
+            elif line.startswith('idle'):
+                self.idle(line)
+
+            elif line == 'noidle':
+                # Not idle, so there's nothing to interrupt and no
+                # response, as in MPD
+                pass
+
+            else:
+                try:
+                    response = self.run(line) + 'OK\n'
+                except ProtocolError as e:
+                    response = self.ack(e, 0, line)
+                self.send(response, commands=[line])
+
+    def ack(self, error, position, line):
+        return 'ACK [%s@%s] {%s} %s\n' % (error.code, position,
+                                          line.split(' ', 1)[0], error)
+
+    def idle(self, line):
+        '''Waits until one of the subsystems changes, or the client sends
+        noidle.'''
+
+        subsystems = set(shlex.split(line)[1:]) or set(SUBSYSTEMS)
+
+        while True:
+            with self.eventsLock:
+                changed = self.events & subsystems
+                if changed:
+                    self.events -= changed
+                    break
+
+            readable = select.select([self.connection], [], [], 0.01)[0]
+            if readable:
+                command = self.readLine()
+                if command is None:
+                    return
+                if command == 'noidle':
+                    changed = set()
+                    break
+
+        self.send(''.join('changed: %s\n' % subsystem
+                          for subsystem in sorted(changed)) + 'OK\n',
+                  commands=['idle'])
+
+    def notify(self, subsystems):
+        with self.eventsLock:
+            self.events.update(subsystems)
+
+    def readLine(self):
+        line = self.rfile.readline()
+        if not line.endswith('\n'):
+            return None
+
+        self.daemon.bytesReceived += len(line)
+
+        return line[:-1]
+
+    def run(self, line):
+        '''Runs one command and returns its response, without the final
+        OK.'''
+
+        try:
+            parts = shlex.split(line)
+        except ValueError:
+            raise ProtocolError('Invalid quoting', code=2)
+
+        command, args = parts[0], parts[1:]
+        method = getattr(self, 'cmd_' + command, None)
+        if method is None:
+            raise ProtocolError('unknown command "%s"' % command, code=5)
+
+        with self.daemon.lock:
+            self.daemon.commands += 1
+            try:
+                return method(*args)
+            except TypeError:
+                raise ProtocolError('wrong number of arguments for "%s"'
+                                    % command, code=2)
+
+    def runCommandList(self, begin, lines):
+        output = []
+        for position, line in enumerate(lines):
+            try:
+                output.append(self.run(line))
+            except ProtocolError as e:
+                output.append(self.ack(e, position, line))
+                return ''.join(output)
+
+            if begin == 'command_list_ok_begin':
+                output.append('list_OK\n')
+
+        output.append('OK\n')
+        return ''.join(output)
+
+    def send(self, response, commands=(), roundTrip=True):
+        daemon = self.daemon
+
+        delay = daemon.latency + sum(
+            daemon.commandLatency.get(line.split(' ', 1)[0], 0)
+            for line in commands)
+        if delay:
+            time.sleep(delay)
+
+        if roundTrip:
+            daemon.roundTrips += 1
+        daemon.bytesSent += len(response)
+
+        self.wfile.write(response)
+        self.wfile.flush()
+
+    def songs(self, entries):
+        '''Returns the response lines for (position, song ID, library
+        index) entries.'''
+
+        library = self.daemon.library
+        lines = []
+        for position, songId, index in entries:
+            lines.extend(library.song(index))
+            lines.append('Pos: %d' % position)
+            lines.append('Id: %d' % songId)
+
+        return ''.join(line + '\n' for line in lines)
+
+    def queueEntries(self, positions=None):
+        queue = self.daemon.queue
+        if positions is None:
+            positions = xrange(len(queue))
+
+        return [(position,) + queue[position] for position in positions]
+
+    def _position(self, value, allowEnd=False):
+        try:
+            position = int(value)
+        except ValueError:
+            raise ProtocolError('Integer expected: %s' % value, code=2)
+
+        limit = len(self.daemon.queue) + (1 if allowEnd else 0)
+        if not 0 <= position < limit:
+            raise ProtocolError('Bad song index', code=50)
+
+        return position
+
+    def _range(self, value):
+        if ':' not in value:
+            position = self._position(value)
+            return position, position + 1
+
+        start, end = value.split(':')
+        start = self._position(start, allowEnd=True)
+        end = (min(int(end), len(self.daemon.queue))
+               if end else len(self.daemon.queue))
+        if end < start:
+            raise ProtocolError('Bad song index', code=50)
+
+        return start, end
+
+    def _songPosition(self, songId):
+        for position, (queuedId, index) in enumerate(self.daemon.queue):
+            if str(queuedId) == songId:
+                return position
+
+        raise ProtocolError('No such song', code=50)
+
+    # *** Connection commands
+
+    def cmd_password(self, password):
+        return ''
+
+    def cmd_ping(self):
+        return ''
+
+    # *** Status commands
+
+    def cmd_currentsong(self):
+        position = self.daemon.currentPosition()
+        if position is None:
+            return ''
+
+        return self.songs(self.queueEntries([position]))
+
+    def cmd_stats(self):
+        daemon = self.daemon
+
+        return ('uptime: %d\nplaytime: 0\nartists: %d\nalbums: %d\n'
+                'songs: %d\ndb_playtime: %d\ndb_update: %d\n'
+                % (time.time() - daemon.startTime,
+                   (len(daemon.library) - 1)
+                   // (TRACKS_PER_ALBUM * ALBUMS_PER_ARTIST) + 1,
+                   (len(daemon.library) - 1) // TRACKS_PER_ALBUM + 1,
+                   len(daemon.library), sum(daemon.library.durations),
+                   daemon.dbUpdate))
+
+    def cmd_status(self):
+        daemon = self.daemon
+
+        lines = ['volume: -1']
+        lines.extend('%s: %s' % option
+                     for option in sorted(daemon.options.items()))
+        lines.append('playlist: %d' % daemon.version)
+        lines.append('playlistlength: %d' % len(daemon.queue))
+        lines.append('state: %s' % daemon.state)
+
+        position = daemon.currentPosition()
+        if position is not None:
+            duration = daemon.library.durations[daemon.queue[position][1]]
+            elapsed = daemon.currentElapsed()
+            lines.append('song: %d' % position)
+            lines.append('songid: %d' % daemon.songId)
+            lines.append('time: %d:%d' % (elapsed, duration))
+            lines.append('elapsed: %.3f' % elapsed)
+            lines.append('duration: %d.000' % duration)
+
+        return ''.join(line + '\n' for line in lines)
+
+    # *** Database commands
+
+    def cmd_find(self, *args):
+        return self._search(args, exact=True)
+
+    def cmd_listallinfo(self, path=''):
+        library = self.daemon.library
+        path = path.strip('/')
+
+        if not path:
+            indexes = xrange(len(library))
+        else:
+            indexes = self._directoryTracks(path)
+
+        return ''.join('\n'.join(library.song(index)) + '\n'
+                       for index in indexes)
+
+    def cmd_lsinfo(self, path=''):
+        library = self.daemon.library
+        path = path.strip('/')
+        perArtist = TRACKS_PER_ALBUM * ALBUMS_PER_ARTIST
+
+        if not path:
+            return ''.join('directory: artist%d\n' % artist for artist in
+                           xrange((len(library) - 1) // perArtist + 1))
+
+        parts = path.split('/')
+        if len(parts) == 1:
+            first = self._directoryTracks(path)[0] // TRACKS_PER_ALBUM
+            return ''.join('directory: %s/album%d\n' % (path, album)
+                           for album in xrange(first, first
+                                               + ALBUMS_PER_ARTIST)
+                           if album * TRACKS_PER_ALBUM < len(library))
+
+        return ''.join('\n'.join(library.song(index)) + '\n'
+                       for index in self._directoryTracks(path))
+
+    def cmd_search(self, *args):
+        return self._search(args)
+
+    def cmd_update(self, path=''):
+        daemon = self.daemon
+        daemon.dbUpdate = int(time.time())
+        daemon.changed('update', 'database')
+
+        return 'updating_db: 1\n'
+
+    cmd_rescan = cmd_update
+
+    def _directoryTracks(self, path):
+        library = self.daemon.library
+        match = re.match(r'^artist(\d+)(?:/album(\d+))?$', path)
+        if not match:
+            raise ProtocolError('No such directory', code=50)
+
+        if match.group(2) is not None:
+            start = int(match.group(2)) * TRACKS_PER_ALBUM
+            count = TRACKS_PER_ALBUM
+        else:
+            start = int(match.group(1)) * TRACKS_PER_ALBUM * ALBUMS_PER_ARTIST
+            count = TRACKS_PER_ALBUM * ALBUMS_PER_ARTIST
+
+        if start >= len(library):
+            raise ProtocolError('No such directory', code=50)
+
+        return range(start, min(start + count, len(library)))
+
+    def _search(self, args, exact=False):
+        library = self.daemon.library
+        match = library.matcher(args, exact=exact,
+                                protocol=self.daemon.protocol)
+
+        return ''.join('\n'.join(library.song(index)) + '\n'
+                       for index in xrange(len(library))
+                       if match(index))
+
+    # *** Queue commands
+
+    def cmd_add(self, path):
+        self.cmd_addid(path)
+
+        return ''
+
+    def cmd_addid(self, path, position=None):
+        daemon = self.daemon
+        index = daemon.library.find(path)
+
+        entry = (daemon.nextId, index)
+        daemon.nextId += 1
+
+        if position is None:
+            position = len(daemon.queue)
+        else:
+            position = self._position(position, allowEnd=True)
+        daemon.queue.insert(position, entry)
+        daemon.queueChanged(position)
+
+        return 'Id: %d\n' % entry[0]
+
+    def cmd_clear(self):
+        removed = self.daemon.queue
+        self.daemon.queue = []
+        self.daemon.queueChanged(0, removed)
+
+        return ''
+
+    def cmd_delete(self, positions):
+        start, end = self._range(positions)
+        removed = self.daemon.queue[start:end]
+        del self.daemon.queue[start:end]
+        self.daemon.queueChanged(start, removed)
+
+        return ''
+
+    def cmd_deleteid(self, songId):
+        position = self._songPosition(songId)
+        removed = self.daemon.queue.pop(position)
+        self.daemon.queueChanged(position, [removed])
+
+        return ''
+
+    def cmd_move(self, positions, to):
+        queue = self.daemon.queue
+        start, end = self._range(positions)
+        entries = queue[start:end]
+        del queue[start:end]
+        to = int(to)
+        if not 0 <= to <= len(queue):
+            queue[start:start] = entries
+            raise ProtocolError('Bad song index', code=50)
+        queue[to:to] = entries
+        self.daemon.queueChanged(min(start, to))
+
+        return ''
+
+    def cmd_moveid(self, songId, to):
+        queue = self.daemon.queue
+        position = self._songPosition(songId)
+        to = int(to)
+        if not 0 <= to < len(queue):
+            raise ProtocolError('Bad song index', code=50)
+        queue.insert(to, queue.pop(position))
+        self.daemon.queueChanged(min(position, to))
+
+        return ''
+
+    def cmd_playlistid(self, songId=None):
+        if songId is None:
+            return self.songs(self.queueEntries())
+
+        return self.songs(self.queueEntries([self._songPosition(songId)]))
+
+    def cmd_playlistinfo(self, positions=None):
+        if positions is None:
+            return self.songs(self.queueEntries())
+
+        return self.songs(self.queueEntries(xrange(*self._range(positions))))
+
+    def cmd_plchanges(self, version, positions=None):
+        return self.songs(self.queueEntries(self._changes(version)))
+
+    def cmd_plchangesposid(self, version, positions=None):
+        queue = self.daemon.queue
+
+        return ''.join('cpos: %d\nId: %d\n' % (position, queue[position][0])
+                       for position in self._changes(version))
+
+    def _changes(self, version):
+        version = int(version)
+
+        return [position for position, changed
+                in enumerate(self.daemon.positionVersions)
+                if changed > version]
+
+    # *** Playback commands
+
+    def cmd_pause(self, pause=None):
+        daemon = self.daemon
+        if daemon.state == 'stop':
+            return ''
+
+        if pause is None:
+            pause = '1' if daemon.state == 'play' else '0'
+
+        if pause == '1' and daemon.state == 'play':
+            daemon.elapsed = daemon.currentElapsed()
+            daemon.state = 'pause'
+        elif pause == '0' and daemon.state == 'pause':
+            daemon.playStart = time.time()
+            daemon.state = 'play'
+        daemon.changed('player')
+
+        return ''
+
+    def cmd_play(self, position=None):
+        daemon = self.daemon
+        if not daemon.queue:
+            return ''
+
+        if position is not None:
+            daemon.startPlaying(daemon.queue[self._position(position)][0])
+        elif daemon.state == 'pause':
+            self.cmd_pause('0')
+        elif daemon.state == 'stop':
+            current = daemon.currentPosition()
+            daemon.startPlaying(daemon.queue[current or 0][0])
+
+        return ''
+
+    def cmd_playid(self, songId=None):
+        if songId is None:
+            return self.cmd_play()
+
+        return self.cmd_play(str(self._songPosition(songId)))
+
+    def cmd_seek(self, position, elapsed):
+        daemon = self.daemon
+        songId = daemon.queue[self._position(position)][0]
+        state = daemon.state
+        daemon.startPlaying(songId, float(elapsed))
+        if state == 'pause':
+            daemon.elapsed = float(elapsed)
+            daemon.state = 'pause'
+
+        return ''
+
+    def cmd_seekid(self, songId, elapsed):
+        return self.cmd_seek(str(self._songPosition(songId)), elapsed)
+
+    def cmd_stop(self):
+        self.daemon.stop()
+
+        return ''
+
+    # *** Stored playlist commands
+
+    def cmd_listplaylist(self, name):
+        library = self.daemon.library
+
+        return ''.join('file: %s\n' % library.path(index)
+                       for index in self._playlist(name))
+
+    def cmd_listplaylists(self):
+        return ''.join('playlist: %s\n' % name
+                       for name in sorted(self.daemon.playlists))
+
+    def cmd_playlistadd(self, name, path):
+        index = self.daemon.library.find(path)
+        self.daemon.playlists.setdefault(name, []).append(index)
+        self.daemon.changed('stored_playlist')
+
+        return ''
+
+    def cmd_playlistclear(self, name):
+        self.daemon.playlists[name] = []
+        self.daemon.changed('stored_playlist')
+
+        return ''
+
+    def cmd_rm(self, name):
+        self._playlist(name)
+        del self.daemon.playlists[name]
+        self.daemon.changed('stored_playlist')
+
+        return ''
+
+    def _playlist(self, name):
+        if name not in self.daemon.playlists:
+            raise ProtocolError('No such playlist', code=50)
+
+        return self.daemon.playlists[name]
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    '''A fake MPD server, on a TCP port or, if path is given, a Unix
+    socket.  Use start() to serve from a thread.'''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, tracks=1000, queue=0,
+                 latency=0, commandLatency=None, seed=0, path=None,
+                 protocolVersion=PROTOCOL_VERSION):
+
+        if path:
+            self.address_family = socket.AF_UNIX
+            SocketServer.TCPServer.__init__(self, path, Handler)
+        else:
+            SocketServer.TCPServer.__init__(self, (host, port), Handler)
+
+        self.daemon = Daemon(Library(tracks, seed=seed), queueSize=queue,
+                             latency=latency, commandLatency=commandLatency,
+                             protocolVersion=protocolVersion)
+
+    @property
+    def address(self):
+        '''HOST:PORT or the socket path, for the scripts' --server
+        option.'''
+
+        if self.address_family == socket.AF_UNIX:
+            return self.server_address
+
+        return '%s:%s' % self.server_address
+
+    def start(self):
+        '''Serves in a daemon thread and returns self.'''
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+        if self.address_family == socket.AF_UNIX:
+            os.unlink(self.server_address)
+
+
+# ** Functions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a fake MPD server with a synthetic library')
+    parser.add_argument('-p', '--port', type=int, default=6600)
+    parser.add_argument('-H', '--host', default='127.0.0.1')
+    parser.add_argument('-u', '--socket', metavar='PATH',
+                        help='Listen on a Unix socket instead of TCP')
+    parser.add_argument('-n', '--tracks', type=int, default=1000,
+                        help='Number of tracks in the library')
+    parser.add_argument('-q', '--queue', type=int, default=0,
+                        help='Number of tracks in the queue at startup')
+    parser.add_argument('-l', '--latency', type=float, default=0,
+                        metavar='SECONDS',
+                        help='Delay before every response')
+    parser.add_argument('-c', '--command-latency', dest='commandLatency',
+                        action='append', default=[],
+                        metavar='COMMAND=SECONDS',
+                        help='Extra delay for each COMMAND, may be repeated')
+    parser.add_argument('-V', '--protocol', dest='protocolVersion',
+                        default=PROTOCOL_VERSION, metavar='VERSION',
+                        help='Protocol version to report; filter '
+                        'expressions need 0.21 and their contains '
+                        'operator 0.24.  Default: %s' % PROTOCOL_VERSION)
+    args = parser.parse_args()
+
+    commandLatency = dict((command, float(seconds)) for command, seconds in
+                          (arg.split('=') for arg in args.commandLatency))
+
+    server = Server(host=args.host, port=args.port, tracks=args.tracks,
+                    queue=args.queue, latency=args.latency,
+                    commandLatency=commandLatency, path=args.socket,
+                    protocolVersion=args.protocolVersion)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        if args.socket:
+            os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
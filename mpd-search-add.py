@@ -4,6 +4,12 @@
 
 # ** Imports
 import argparse
+import array
+import atexit
+import bisect
+import collections
+import itertools
+import json
 import logging
 import os
 import random
@@ -12,157 +18,580 @@ import sys
 
 import mpd  # Using python-mpd2
 
+from mpdcommon import (DEFAULT_PORT, BaseClient, PhaseTracer, loadPickle,
+                       parallel, savePickle, subsetSum, writeAtomically,
+                       writeCommandStats)
+
 # Verify python-mpd2 is being used
 if mpd.VERSION < (0, 5, 4):
     print 'ERROR: This script requires python-mpd2 >= 0.5.4.'
     sys.exit(1)
 
 # ** Constants
-DEFAULT_PORT = 6600
-FILE_PREFIX_RE = re.compile('^file: ')
+ADD_BATCH_SIZE = 1000  # Add commands per command list
+EARLY_START_TRACKS = 3  # Tracks to queue before playing with --early-start
+QUERY_CACHE_SIZE = 100000  # Tracks kept in the query cache
+STREAM_SAMPLE_SIZE = 5000  # Tracks to pick from with --stream and a duration
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)  # Words in the library index
 
 
 # ** Classes
 
 
-class Track(object):
-    def __init__(self, duration=None, title=None, path=None):
-        self.duration = int(duration)
-        self.title = title
-        self.path = path
+class TrackStore(object):
+    '''A table of tracks indexed by integer track IDs, with a list of
+    paths and a parallel array of durations.  Each path is only stored
+    once, so deduplicating tracks is just deduplicating their IDs.'''
+
+    def __init__(self):
+        self.paths = []
+        self.durations = array.array('l')
+
+        # Path -> ID, built on first use by add()
+        self._ids = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, path, duration):
+        '''Returns the ID of the track at path, adding it if necessary.'''
+
+        if self._ids is None:
+            self._ids = dict((path, i) for i, path in enumerate(self.paths))
 
-    # These two are the magic that makes sets work
-    def __eq__(self, other):
-        return self.path == other.path
+        trackId = self._ids.get(path)
+        if trackId is None:
+            trackId = self._ids[path] = len(self.paths)
+            self.paths.append(path)
+            self.durations.append(duration)
 
-    def __hash__(self):
-        return hash(self.path)
+        return trackId
 
-    def __str__(self):
-        return os.path.basename(self.path)
+    def name(self, trackId):
+        '''Returns the filename of a track, for logging.'''
+
+        return os.path.basename(self.paths[trackId])
 
 
 class Playlist(list):
-    def __init__(self, *args, **kwargs):
-        super(Playlist, self).__init__(args)
-        self.duration = sum([track.duration for track in args]) if args else 0
+    '''A list of track IDs in a TrackStore that keeps its total
+    duration up to date.'''
 
-    def append(self, item):
-        super(Playlist, self).append(item)
+    def __init__(self, store, trackIds=()):
+        super(Playlist, self).__init__(trackIds)
+        self.store = store
 
-        # TODO: Is there a more Pythonic way to do this?
-        self.duration += (sum([track.duration for track in item])
-                          if isinstance(item, list)
-                          or isinstance(item, set)
-                          else item.duration)
+        durations = store.durations
+        self.duration = sum(durations[i] for i in self)
 
-    def extend(self, item):
-        super(Playlist, self).extend(item)
+    def append(self, trackId):
+        super(Playlist, self).append(trackId)
+        self.duration += self.store.durations[trackId]
 
-        # TODO: Is there a more Pythonic way to do this?
+    def extend(self, trackIds):
+        trackIds = list(trackIds)
+        super(Playlist, self).extend(trackIds)
 
+        durations = self.store.durations
+        self.duration += sum(durations[i] for i in trackIds)
 
-class Client(mpd.MPDClient):
-    '''Subclasses mpd.MPDClient, keeping state data, reconnecting as
-    needed, etc.'''
+    def paths(self):
+        '''Returns a list of the tracks' paths.'''
 
-    initAttrs = {None: ['currentStatus', 'lastSong',
-                        'currentSongFiletype', 'playlist',
-                        'playlistVersion', 'playlistLength',
-                        'song', 'duration', 'elapsed', 'state',
-                        'hasBeenSynced', 'playing', 'paused'],
-                 False: ['consume', 'random', 'repeat',
-                         'single']}
+        paths = self.store.paths
+        return [paths[i] for i in self]
 
-    def __init__(self, host, port=DEFAULT_PORT, password=None, latency=None,
-                 logger=None):
 
-        super(Client, self).__init__()
+class TrackIndex(object):
+    '''Track IDs sorted by duration, with a Fenwick tree counting which
+    ones are still available.  Counting, picking and removing the
+    tracks shorter than a given duration are all O(log n).'''
 
-        # Command timeout
-        self.timeout = 10
+    def __init__(self, store, trackIds):
+        self.tracks = array.array('l', sorted(trackIds,
+                                              key=store.durations.__getitem__))
+        self.durations = array.array('l', (store.durations[i]
+                                           for i in self.tracks))
 
-        # Split host/latency
-        if '/' in host:
-            host, latency = host.split('/')
+        # Positions of removed tracks, so restore() doesn't have to
+        # rebuild the whole tree
+        self.removed = []
 
-        if latency is not None:
-            self.latency = float(latency)
-        else:
-            self.latency = None
+        # Build the tree with every track available.  Each node holds
+        # the count of its range; this is the O(n) construction.
+        size = len(self.tracks)
+        self._tree = [0] + [1] * size
+        for i in xrange(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                self._tree[parent] += self._tree[i]
+
+        # Highest power of 2 <= size, for searching the tree
+        self._topBit = 1 << (size.bit_length() - 1) if size else 0
+
+    def count(self, maxDuration):
+        '''Returns the number of available tracks shorter than
+        maxDuration.'''
+
+        return self._prefixSum(bisect.bisect_left(self.durations,
+                                                  maxDuration))
+
+    def pick(self, maxDuration, remove=True):
+        '''Returns the ID of a random available track shorter than
+        maxDuration, optionally removing it, or None if there are
+        none.'''
+
+        count = self.count(maxDuration)
+        if not count:
+            return None
+
+        position = self._find(random.randint(1, count))
+        if remove:
+            self._update(position, -1)
+            self.removed.append(position)
+
+        return self.tracks[position]
+
+    def restore(self):
+        '''Makes all removed tracks available again.'''
+
+        for position in self.removed:
+            self._update(position, 1)
+
+        self.removed = []
+
+    def _find(self, n):
+        '''Returns the position of the nth available track.'''
+
+        i = 0
+        bit = self._topBit
+        while bit:
+            if i + bit < len(self._tree) and self._tree[i + bit] < n:
+                i += bit
+                n -= self._tree[i]
+            bit >>= 1
+
+        return i
+
+    def _prefixSum(self, end):
+        '''Returns the number of available tracks before position end.'''
+
+        total = 0
+        while end:
+            total += self._tree[end]
+            end -= end & -end
+
+        return total
 
-        # Split host/port
-        if ':' in host:
-            host, port = host.split(':')
+    def _update(self, position, delta):
+        '''Adds delta to the availability of the track at position.'''
 
-        self.host = host
-        self.port = port
-        self.password = password
+        i = position + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
 
-        self.log = logger.getChild('%s(%s)' %
-                                   (self.__class__.__name__, self.host))
 
-    def checkConnection(self):
-        '''Pings the daemon and tries to reconnect if necessary.'''
+class Library(TrackStore):
+    '''A local snapshot of the daemon's library, built from listallinfo
+    and stored on disk.  The snapshot is reused as long as the
+    daemon's db_update stat hasn't changed, so searches can be
+    answered without asking the daemon.
+
+    Searches are answered from an inverted index of the words in each
+    column, so only the tracks containing every word of a query have
+    to be checked.'''
+
+    # Bump this when the on-disk format changes
+    formatVersion = 4
+
+    # Columns are lowercased for case-insensitive matching, like MPD's
+    # search command.  'file' is the path, which MPD also checks when
+    # searching 'any'.
+    columnNames = ['artist', 'album', 'title', 'genre', 'file']
+
+    # What build() gets from the daemon for each song
+    fieldNames = ['file', 'time', 'artist', 'album', 'title', 'genre']
+
+    # Stop looking up the words of a query once fewer tracks than this
+    # contain the words looked up so far
+    checkLimit = 1000
+
+    def __init__(self, path, logger=None):
+        super(Library, self).__init__()
+
+        self.path = path
+        self.log = logger.getChild(self.__class__.__name__)
+
+        self._reset()
+
+    def build(self, daemon):
+        '''Builds the snapshot from the daemon's library.'''
+
+        self._reset()
+        self.address = daemon.address
+
+        # Listing one top-level directory at a time keeps each
+        # response under MPD's output buffer limit on big libraries
+        for entry in list(daemon.songFields(['directory'] + self.fieldNames,
+                                            'lsinfo')):
+            if entry[0] is not None:
+                for song in daemon.songFields(self.fieldNames, 'listallinfo',
+                                              entry[0]):
+                    self._addSong(song)
+            else:
+                self._addSong(entry[1:])
+
+        self._buildIndex()
+
+        self.log.debug('Built library snapshot with %s tracks and %s words',
+                       len(self), sum(map(len, self.index.values())))
+
+    def load(self, daemon):
+        '''Loads the snapshot from disk, rebuilding and saving it if it is
+        missing or the daemon's database has changed since it was
+        built.'''
+
+        dbUpdate = daemon.stats()['db_update']
+
+        if (self._read()
+            and self.address == daemon.address
+            and self.dbUpdate == dbUpdate):
+
+            self.log.debug('Using library snapshot from %s (db_update %s)',
+                           self.path, self.dbUpdate)
+            return
+
+        self.log.info('Library snapshot out of date; rebuilding...')
+
+        self.build(daemon)
+        self.dbUpdate = dbUpdate
+        self.save()
+
+    def save(self):
+        '''Writes the snapshot to disk.'''
+
+        data = {'address': self.address,
+                'dbUpdate': self.dbUpdate,
+                'paths': self.paths,
+                'durations': self.durations.tostring(),
+                'columns': self.columns,
+                'index': self.index}
 
-        # I don't know why this is necessary, but for some reason the
-        # slave connections tend to get dropped.
         try:
-            self.ping()
+            savePickle(self.path, self.formatVersion, data)
+        except (IOError, OSError) as e:
+            self.log.warning('Unable to save library snapshot to %s: %s',
+                             self.path, e)
+
+    def search(self, queryType, query):
+        '''Returns a list of IDs of tracks matching query, like MPD's
+        search command, except that "any" only checks the columns in
+        the snapshot.'''
+
+        query = self._normalize(query)
+        names = (self.columnNames
+                 if queryType == 'any'
+                 else [queryType])
+        words = TOKEN_RE.findall(query)
+
+        matches = set()
+        for name in names:
+            column = self.columns[name]
+
+            if not words:
+                # Nothing to look up, e.g. only punctuation
+                candidates = xrange(len(column))
+
+            else:
+                # A value containing the query contains every word of
+                # the query inside one of its own words.  Look up the
+                # words found in the fewest of the column's words
+                # first, since they usually narrow it down the most.
+                vocabulary = self._vocabulary(name)
+                candidates = None
+                for word in sorted(words, key=lambda word: (
+                        vocabulary.count(word), -len(word))):
+                    found = self._lookup(name, word)
+                    candidates = (found if candidates is None
+                                  else candidates.intersection(found))
+
+                    # Checking a few tracks is cheaper than looking up
+                    # a common word
+                    if len(candidates) < self.checkLimit:
+                        break
+
+            matches.update(i for i in candidates if query in column[i])
+
+        return sorted(matches)
+
+    def _addSong(self, song):
+        '''Adds a song from the daemon, a tuple of the values of
+        fieldNames, to the snapshot.'''
+
+        values = dict(zip(self.fieldNames, song))
+        self.add(values['file'], int(round(values['time'] or 0)))
+
+        for name in self.columnNames:
+            self.columns[name].append(self._normalize(values[name] or ''))
+
+    def _buildIndex(self):
+        '''Builds the inverted index from the columns.'''
+
+        self.index = {}
+        for name in self.columnNames:
+            postings = collections.defaultdict(lambda: array.array('l'))
+            for i, value in enumerate(self.columns[name]):
+                for word in set(TOKEN_RE.findall(value)):
+                    postings[word].append(i)
+
+            # Stored as strings, which pickle much faster than arrays
+            self.index[name] = dict((word, trackIds.tostring())
+                                    for word, trackIds in postings.iteritems())
+
+    def _lookup(self, name, word):
+        '''Returns the set of IDs of tracks with a word containing word in
+        column name.'''
+
+        key = (name, word)
+        if key not in self._lookups:
+            vocabulary = self._vocabulary(name)
+
+            # Finding the word in all the words at once is much faster
+            # than checking them one at a time
+            found = set()
+            position = vocabulary.find(word)
+            while position != -1:
+                start = vocabulary.rfind('\n', 0, position) + 1
+                end = vocabulary.find('\n', position)
+
+                postings = array.array('l')
+                postings.fromstring(self.index[name][vocabulary[start:end]])
+                found.update(postings)
+
+                position = vocabulary.find(word, end)
+
+            self._lookups[key] = found
+
+        return self._lookups[key]
+
+    def _vocabulary(self, name):
+        '''Returns all the words in column name, one per line.'''
+
+        if name not in self._vocabularies:
+            self._vocabularies[name] = '\n%s\n' % '\n'.join(self.index[name])
+
+        return self._vocabularies[name]
+
+    def _normalize(self, value):
+        '''Returns value lowercased for matching.'''
+
+        return value.decode('utf-8', 'replace').lower()
+
+    def _reset(self):
+        '''Empties the snapshot.'''
+
+        TrackStore.__init__(self)
+
+        # HOST:PORT or socket path of the daemon, since several daemons
+        # on one host can share a path
+        self.address = None
+        self.dbUpdate = None
+        self.columns = dict((name, []) for name in self.columnNames)
+
+        # Column name -> word -> track IDs, as array strings
+        self.index = dict((name, {}) for name in self.columnNames)
+
+        # Caches for _lookup(): (column name, word) -> set of track
+        # IDs, and column name -> all its words, one per line
+        self._lookups = {}
+        self._vocabularies = {}
 
+    def _read(self):
+        '''Reads the snapshot from disk.  Returns True if successful.'''
+
+        try:
+            data = loadPickle(self.path, self.formatVersion)
         except Exception as e:
-            self.log.debug('Connection to "%s" seems to be down.  '
-                           'Trying to reconnect...', self.host)
+            self.log.warning('Unable to read library snapshot from %s: %s',
+                             self.path, e)
+            return False
 
-            # Try to disconnect first
-            try:
-                self.disconnect()  # Maybe this will help it reconnect
-            except Exception as e:
-                self.log.exception("Couldn't DISconnect from client %s: %s",
-                                   self.host, e)
+        if data is None:
+            return False
 
-            # Try to reconnect
-            try:
-                self.connect()
-            except Exception as e:
-                self.log.critical('Unable to reconnect to "%s"', self.host)
+        self.address = data['address']
+        self.dbUpdate = data['dbUpdate']
+        self.paths = data['paths']
+        self.durations = array.array('l')
+        self.durations.fromstring(data['durations'])
+        self.columns = data['columns']
+        self.index = data['index']
+        self._lookups = {}
+        self._vocabularies = {}
 
-                return False
-            else:
-                self.log.debug('Reconnected to "%s"', self.host)
+        return True
+
+
+class QueryCache(object):
+    '''Results of searches, stored on disk so repeated queries can be
+    answered without searching again.  Results from a daemon are
+    dropped when its db_update stat changes, and the least recently
+    used results are dropped when the cache holds more than size
+    tracks.'''
+
+    # Bump this when the on-disk format changes
+    formatVersion = 1
+
+    def __init__(self, path, size=QUERY_CACHE_SIZE, logger=None):
+        self.path = path
+        self.size = size
+        self.log = logger.getChild(self.__class__.__name__)
+
+        # Server address -> db_update stat when its results were stored
+        self.dbUpdates = {}
+
+        # (server, queryType, query) -> (paths, durations), least
+        # recently used first
+        self.results = collections.OrderedDict()
+        self.tracks = 0
+
+        self._changed = False
+
+    def load(self, daemon):
+        '''Loads the cache from disk, dropping the daemon's results if its
+        database has changed since they were stored.'''
+
+        self._read()
+
+        dbUpdate = daemon.stats()['db_update']
+        if self.dbUpdates.get(daemon.address) != dbUpdate:
+            for key in [key for key in self.results
+                        if key[0] == daemon.address]:
+                self._remove(key)
+
+            self.dbUpdates[daemon.address] = dbUpdate
+            self._changed = True
+
+        # The size may be smaller than when the cache was saved
+        self._evict()
+
+    def get(self, server, queryType, query):
+        '''Returns (paths, durations) found by a search, or None if it isn't
+        cached.'''
+
+        key = (server, queryType, query)
+        result = self.results.pop(key, None)
+        if result is not None:
+            # Move it to the most recently used end
+            self.results[key] = result
+            self._changed = True
+
+        return result
 
-                return True
+    def put(self, server, queryType, query, songs):
+        '''Stores the (path, duration) of each song found by a search and
+        returns them as (paths, durations).'''
 
+        key = (server, queryType, query)
+        if key in self.results:
+            self._remove(key)
+
+        paths = [path for path, duration in songs]
+        durations = array.array('l', (int(round(duration or 0))
+                                      for path, duration in songs))
+        self.results[key] = (paths, durations)
+        self.tracks += len(paths)
+        self._changed = True
+
+        self._evict()
+
+        return paths, durations
+
+    def save(self):
+        '''Writes the cache to disk if it has changed.'''
+
+        if not self._changed:
+            return
+
+        data = {'dbUpdates': self.dbUpdates,
+                'results': [(key, paths, durations.tostring())
+                            for key, (paths, durations)
+                            in self.results.iteritems()]}
+
+        try:
+            savePickle(self.path, self.formatVersion, data)
+        except (IOError, OSError) as e:
+            self.log.warning('Unable to save query cache to %s: %s',
+                             self.path, e)
         else:
-            self.log.debug("Connection still up to %s", self.host)
+            self._changed = False
 
-            return True
+    def _evict(self):
+        '''Drops the least recently used results until the cache fits in
+        its size, but always keeps the newest.'''
+
+        while self.tracks > self.size and len(self.results) > 1:
+            self._remove(next(iter(self.results)))
+            self._changed = True
+
+    def _remove(self, key):
+        '''Drops one result.'''
+
+        paths, durations = self.results.pop(key)
+        self.tracks -= len(paths)
+
+    def _read(self):
+        '''Reads the cache from disk.  Returns True if successful.'''
 
-    def connect(self):
-        '''Connects to the daemon, sets the password if necessary, and tests
-        the ping time.'''
+        try:
+            data = loadPickle(self.path, self.formatVersion)
+        except Exception as e:
+            self.log.warning('Unable to read query cache from %s: %s',
+                             self.path, e)
+            return False
+
+        if data is None:
+            return False
+
+        self.dbUpdates = data['dbUpdates']
+        self.results = collections.OrderedDict()
+        self.tracks = 0
+        for key, paths, durationString in data['results']:
+            durations = array.array('l')
+            durations.fromstring(durationString)
+            self.results[key] = (paths, durations)
+            self.tracks += len(paths)
 
-        # Reset initial values
-        for val, attrs in self.initAttrs.iteritems():
-            for attr in attrs:
-                setattr(self, attr, val)
+        return True
 
-        super(Client, self).connect(self.host, self.port)
 
-        if self.password:
-            super(Client, self).password(self.password)
+class JobCache(object):
+    '''Library snapshots and search results shared by the jobs of a
+    batch (--jobs), so each is only loaded or searched for once.'''
 
-    def getPlaylist(self):
-        '''Gets the playlist from the daemon.'''
+    def __init__(self):
+        # (snapshot path, server address) -> Library
+        self.libraries = {}
 
-        self.playlist = super(Client, self).playlist()
+        # (server address, search arguments...) -> list of (path,
+        # duration), for searchSongs()
+        self.searches = {}
+
+
+class Client(BaseClient):
+    '''Subclasses BaseClient, keeping state data, reconnecting as
+    needed, etc.'''
 
-    def pause(self):
-        '''Pauses the daemon and tracks the playing state.'''
+    def supportsFilters(self):
+        '''Returns True if the daemon understands the expressions
+        filterExpression() makes.  Filter expressions were added in MPD
+        0.21, but their "contains" operator only in 0.24, so older
+        daemons are searched with a command list instead.'''
 
-        super(Client, self).pause()
-        self.playing = False
-        self.paused = True
+        version = tuple(int(n) for n in self.mpd_version.split('.')[:2])
+
+        return version >= (0, 24)
 
     def play(self, initial=False):
         '''Plays the daemon, adjusting starting position as necessary.'''
@@ -172,83 +601,268 @@ class Client(mpd.MPDClient):
 
         return result
 
-    def seek(self, song, elapsed):
-        '''Seeks daemon to a position and updates local attributes for current
-        song and elapsed time.'''
 
-        self.song = song
-        self.elapsed = elapsed
-        super(Client, self).seek(self.song, self.elapsed)
+# ** Functions
 
+def addPaths(daemon, paths, playlist=None):
+    '''Adds paths to the daemon's queue, or to its stored playlist named
+    playlist, in batched command lists, so the daemon is never
+    blocked on one huge command list.'''
 
-# ** Functions
+    for i in xrange(0, len(paths), ADD_BATCH_SIZE):
+        daemon.command_list_ok_begin()
+        for path in paths[i:i + ADD_BATCH_SIZE]:
+            if playlist is None:
+                daemon.add(path)
+            else:
+                daemon.playlistadd(playlist, path)
+        daemon.command_list_end()
 
-def main():
 
-    # *** Parse args
-    parser = argparse.ArgumentParser(
-        description='Search for tracks in an MPD library and'
-        'add them to its playlist')
+def applyPlaylist(daemon, paths, update=False, earlyStart=False):
+    '''Makes the daemon's queue paths and plays it.  With update, the
+    queue is changed as little as possible, leaving the current song
+    alone; with earlyStart, playing starts after the first few tracks
+    are added.'''
 
-    # TODO: parse any number, with or without 'm' or 'h' at the end,
-    # as length in minutes or hours
-    parser.add_argument('-d', '--duration', metavar="MINUTES",
-                        help="Desired duration of queue in minutes")
-    parser.add_argument('-s', '--server', default='localhost', dest='host',
-                        help='Name or address of server, optionally with'
-                        'port in HOST:PORT format.  Default: localhost:6600')
+    if update:
+        # Change the queue as little as possible, leaving the current
+        # song alone
+        daemon.command_list_ok_begin()
+        daemon.status()
+        daemon.songFields(['id', 'file'], 'playlistinfo')
+        status, queue = daemon.command_list_end()
 
-    # TODO: Use action='append' and flatten resulting lists
-    parser.add_argument('-A', '--any', nargs='*')
-    parser.add_argument('-a', '--artists', dest='artist', nargs='*')
-    parser.add_argument('-b', '--albums', dest='album', nargs='*')
-    parser.add_argument('-t', '--titles', dest='title', nargs='*')
-    parser.add_argument('-g', '--genres', dest='genre', nargs='*')
+        playing = status['state'] in ['play', 'pause']
+        commands = diffQueue(queue, paths,
+                             currentId=(status.get('songid')
+                                        if playing else None))
 
-    parser.add_argument('-p', '--print-filenames',
-                        dest='printFilenames', action="store_true")
+        daemon.log.debug('Updating queue with %s commands', len(commands))
 
-    parser.add_argument("-v", "--verbose", action="count", dest="verbose",
-                        help="Be verbose, up to -vvv")
-    args = parser.parse_args()
+        runCommands(daemon, commands)
 
-    queries = ['any', 'artist', 'album', 'title', 'genre']
+        if not playing:
+            daemon.play()
 
-    # *** Setup logging
-    log = logging.getLogger('trim-mpd-queue')
-    if args.verbose >= 3:
-        # Debug everything, including MPD module.  This sets the root
-        # logger, which python-mpd2 uses.  Too bad it doesn't use a
-        # logging.NullHandler to make this cleaner.  See
-        # https://docs.python.org/2/howto/logging.html#library-config
-        LOG_LEVEL = logging.DEBUG
-        logging.basicConfig(level=LOG_LEVEL,
-                            format="%(levelname)s: %(name)s: %(message)s")
+    elif earlyStart:
+        # Start playing after the first few tracks, in one round trip,
+        # and add the rest while they play
+        daemon.command_list_ok_begin()
+        daemon.clear()
+        for path in paths[:EARLY_START_TRACKS]:
+            daemon.add(path)
+        daemon.play()
+        daemon.command_list_end()
+
+        addPaths(daemon, paths[EARLY_START_TRACKS:])
 
     else:
-        # Don't debug MPD.  Don't set the root logger.  Do manually
-        # what basicConfig() does, because basicConfig() sets the root
-        # logger.  This seems more confusing than it should be.  I
-        # think the key is that logging.logger.getChild() is not in
-        # the logging howto tutorials.  When I found getChild() (which
-        # is in the API docs, which are also not obviously linked in
-        # the howto), it started falling into place.  But without
-        # getchild(), it was a confusing mess.
-        if args.verbose == 1:
-            LOG_LEVEL = logging.INFO
-        elif args.verbose == 2:
-            LOG_LEVEL = logging.DEBUG
+        daemon.clear()
+        addPaths(daemon, paths)
+        daemon.play()
+
+
+def checkPlaylistName(name):
+    '''Raises ValueError if name can't be the name of a stored
+    playlist.  Like MPD, names can't be empty or contain "/" or
+    newlines, so writePlaylist() can't write outside its directory.'''
+
+    if not name or any(c in name for c in '/\r\n'):
+        raise ValueError('Invalid playlist name: %r' % name)
+
+
+def combineResults(included, excluded=(), matchAll=False):
+    '''Returns a sorted list of the track IDs in any of the lists in
+    included, or in all of them if matchAll is set, and in none of the
+    lists in excluded.'''
+
+    trackIds = set(included[0])
+    for trackIdList in included[1:]:
+        if matchAll:
+            trackIds.intersection_update(trackIdList)
         else:
-            LOG_LEVEL = logging.WARNING
+            trackIds.update(trackIdList)
+
+    for trackIdList in excluded:
+        trackIds.difference_update(trackIdList)
+
+    return sorted(trackIds)
+
+
+def diffQueue(queue, paths, currentId=None):
+    '''Returns a list of (command, args) tuples that turn queue, a list
+    of (songId, path) tuples in playlist order, into paths, using as
+    few deleteid, addid and moveid commands as possible.
+
+    If currentId is given, that song is kept as it is, and paths are
+    placed after it.  If its path is also in paths, that occurrence is
+    served by the current song instead of being added again.'''
+
+    target = list(paths)
+    current = None
+    if currentId is not None:
+        current = dict(queue).get(currentId)
+
+    if current is not None:
+        if current in target:
+            target.remove(current)
+        target.insert(0, current)
+
+    # Match each target position with a queued song of the same path,
+    # in playlist order, so songs are reused instead of re-added
+    available = collections.defaultdict(collections.deque)
+    for songId, path in queue:
+        if songId != currentId:
+            available[path].append(songId)
+
+    matches = {}  # Song ID -> target position
+    if current is not None:
+        matches[currentId] = 0
+    for position in xrange(len(matches), len(target)):
+        ids = available.get(target[position])
+        if ids:
+            matches[ids.popleft()] = position
+
+    commands = [('deleteid', (songId,))
+                for songId, path in queue
+                if songId not in matches]
+
+    # What's left of the queue, as target positions
+    remaining = [matches[songId] for songId, path in queue
+                 if songId in matches]
+    idAt = dict((position, songId)
+                for songId, position in matches.iteritems())
+
+    # The longest run of remaining songs that are already in order can
+    # stay where they are; everything else is moved or added next to
+    # its predecessor.  The current song is always part of the run.
+    if current is not None:
+        start = remaining.index(0)
+        stay = set([0]) | longestIncreasing(remaining[start + 1:])
+    else:
+        stay = longestIncreasing(remaining)
 
-        handler = logging.StreamHandler()
-        handler.setFormatter(
-            logging.Formatter("%(levelname)s: %(name)s: %(message)s"))
-        log.addHandler(handler)
-        log.setLevel(LOG_LEVEL)
+    for position in xrange(len(target)):
+        if position in stay:
+            continue
 
-    log.debug('Using python-mpd version: %s', str(mpd.VERSION))
-    log.debug("Args: %s", args)
+        if position in idAt:
+            remaining.remove(position)
+
+        to = remaining.index(position - 1) + 1 if position else 0
+        remaining.insert(to, position)
+
+        if position in idAt:
+            commands.append(('moveid', (idAt[position], to)))
+        else:
+            commands.append(('addid', (target[position], to)))
+
+    return commands
+
+
+def filterExpression(included, excluded=(), matchAll=False):
+    '''Returns an MPD filter expression matching the songs that
+    combineResults() would find by searching for each (queryType,
+    query) in included and excluded.'''
+
+    def clause(term):
+        queryType, query = term
+        return "(%s contains '%s')" % (queryType,
+                                       query.replace('\\', '\\\\')
+                                       .replace("'", "\\'"))
+
+    clauses = map(clause, included)
+
+    if len(clauses) == 1:
+        expression = clauses[0]
+    elif matchAll:
+        expression = '(%s)' % ' AND '.join(clauses)
+    else:
+        # Filter expressions have AND and NOT, but not OR, so match
+        # songs that don't fail to match every clause
+        expression = '(!(%s))' % ' AND '.join('(!%s)' % clause
+                                               for clause in clauses)
+
+    if excluded:
+        expression = '(%s)' % ' AND '.join(
+            [expression] + ['(!%s)' % clause(term) for term in excluded])
+
+    return expression
+
+
+def jobArguments(parser, job):
+    '''Returns the command line arguments for a job from a --jobs file, a
+    dict of long option names, like "genres", and their values.  A
+    true value turns a flag on.  A list value gives all its items to
+    an option that takes several, and repeats one that can be given
+    more than once, like "server".'''
+
+    actions = dict((option, action) for action in parser._actions
+                   for option in action.option_strings)
+
+    arguments = []
+    for name, value in sorted(job.iteritems()):
+        option = '--' + name
+        action = actions.get(option)
+        if action is None or option == '--jobs':
+            raise ValueError('Unknown option: %s' % name)
+
+        if value is None or value is False:
+            continue
+        if value is True:
+            arguments.append(option)
+            continue
+
+        values = [unicode(item).encode('utf-8')
+                  for item in (value if isinstance(value, list)
+                               else [value])]
+        if action.nargs in ['*', '+']:
+            arguments.append(option)
+            arguments.extend(values)
+        else:
+            for item in values:
+                arguments.extend([option, item])
+
+    return arguments
+
+
+def longestIncreasing(values):
+    '''Returns the set of values in the longest strictly increasing
+    subsequence of values, in O(n log n).'''
+
+    tails = []  # Index of the smallest tail of each length so far
+    tailValues = []
+    previous = [None] * len(values)
+
+    for i, value in enumerate(values):
+        length = bisect.bisect_left(tailValues, value)
+        if length:
+            previous[i] = tails[length - 1]
+
+        if length == len(tails):
+            tails.append(i)
+            tailValues.append(value)
+        else:
+            tails[length] = i
+            tailValues[length] = value
+
+    result = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        result.add(values[i])
+        i = previous[i]
+
+    return result
+
+
+def makePlaylist(args, log, tracer, daemons, cache=None):
+    '''Makes the playlist that args, from the command line or a job,
+    asks for.  Clients it uses are added to daemons.  With a JobCache,
+    library snapshots and searches are shared with other jobs.
+    Returns True if successful.'''
+
+    queries = ['any', 'artist', 'album', 'title', 'genre']
 
     # *** Check args
     found = False
@@ -261,8 +875,51 @@ def main():
         log.error("Please give a query.")
         return False
 
+    # Queries starting with "!" exclude the tracks they match
+    included = [(queryType, query)
+                for queryType in queries
+                if getattr(args, queryType)
+                for query in getattr(args, queryType)
+                if not query.startswith('!')]
+    excluded = [(queryType, query[1:])
+                for queryType in queries
+                if getattr(args, queryType)
+                for query in getattr(args, queryType)
+                if query.startswith('!')]
+    terms = included + excluded
+
+    if not included:
+        log.error("Please give a query that doesn't start with \"!\".")
+        return False
+
+    if args.stream and args.update and not args.duration:
+        log.error("Can't update the queue while streaming without a "
+                  "duration.")
+        return False
+
+    if args.playlist and (args.update or args.earlyStart):
+        log.error('--update and --early-start only apply to the queue, '
+                  'not to stored playlists.')
+        return False
+
+    if args.playlistDirectory and not args.playlist:
+        log.error('Please give the name of the playlist to write to the '
+                  'playlist directory.')
+        return False
+
+    if args.playlist is not None:
+        try:
+            checkPlaylistName(args.playlist)
+        except ValueError as e:
+            log.error('%s', e)
+            return False
+
     # *** Connect to the master server
-    daemon = Client(host=args.host, port=DEFAULT_PORT, logger=log)
+    tracer.phase('connect')
+    servers = [Client.shared(host=host, port=DEFAULT_PORT, logger=log)
+               for host in args.hosts or [None]]
+    daemon = servers[0]
+    daemons.extend(server for server in servers if server not in daemons)
 
     try:
         daemon.connect()
@@ -272,16 +929,169 @@ def main():
     else:
         log.debug('Connected to master server.')
 
+    # *** Load library snapshot
+    if args.libraryCache:
+        tracer.phase('library')
+        key = (args.libraryCache, daemon.address)
+        library = cache.libraries.get(key) if cache else None
+
+        if library is None:
+            library = Library(args.libraryCache, logger=log)
+
+            try:
+                library.load(daemon)
+            except Exception as e:
+                log.exception('Unable to load library snapshot: %s', e)
+                return False
+
+            if cache:
+                cache.libraries[key] = library
+
+    else:
+        library = None
+
+    # *** Load query cache
+    if args.queryCache and library is None:
+        tracer.phase('cache')
+        queryCache = QueryCache(args.queryCache, args.queryCacheSize,
+                                logger=log)
+
+        try:
+            queryCache.load(daemon)
+        except Exception as e:
+            log.exception('Unable to load query cache: %s', e)
+            return False
+
+    else:
+        queryCache = None
+
+    # Tracks are referred to by their IDs in here
+    store = library if library is not None else TrackStore()
+
     # *** Find songs
-    pools = []
+    tracer.phase('search')
+    searchPending = False
+
+    if library is not None:
+        # Answer from the snapshot instead of the daemon
+        results = [library.search(queryType, query)
+                   for queryType, query in terms]
+
+    elif queryCache is not None:
+        # Search only for the terms that aren't cached, all at once
+        cached = dict((term, queryCache.get(daemon.address, *term))
+                      for term in terms)
+        misses = sorted(set(term for term in terms if cached[term] is None))
+        log.debug('Query cache: %s hits, %s misses',
+                  len(terms) - len(misses), len(misses))
+
+        for term, songs in zip(misses, searchSongs(daemon, misses)):
+            cached[term] = queryCache.put(daemon.address, term[0], term[1],
+                                          songs)
+
+        queryCache.save()
+
+        results = [[store.add(path, duration)
+                    for path, duration in zip(*cached[term])]
+                   for term in terms]
+
+    elif daemon.supportsFilters():
+        # Let the daemon combine the queries into one result
+        results = None
+        expression = filterExpression(included, excluded, args.matchAll)
+
+        if cache:
+            songs = iter(searchSongs(daemon, [(expression,)],
+                                     cache.searches)[0])
+        else:
+            # Read as it's used
+            songs = daemon.songFields(['file', 'time'], 'search',
+                                      expression)
+            searchPending = True
+
+    else:
+        # Send all the searches at once and sort out the results after
+        results = [tracksFromSongs(store, songs)
+                   for songs in searchSongs(daemon, terms,
+                                            cache.searches if cache
+                                            else None)]
+
+    if results is not None:
+        songs = None
+        pools = [Playlist(store, combineResults(results[:len(included)],
+                                                results[len(included):],
+                                                args.matchAll))]
+
+    if args.stream and not args.duration:
+        # *** Stream tracks into the queue as they're found
+        tracer.phase('queue')
+
+        queueDaemons = list(servers)
+        if songs is None:
+            songs = ((store.paths[i], store.durations[i]) for i in pools[0])
+        elif searchPending:
+            # The search is still being read from the daemon's
+            # connection, so the queue needs another one
+            queueDaemons[0] = Client(daemon.host, daemon.port,
+                                     daemon.password, logger=log)
+            daemons.append(queueDaemons[0])
+
+        # Skip broken durations, as below
+        paths = (path for path, duration in songs if duration > 0)
+
+        if args.printFilenames:
+            for path in paths:
+                print path
+            return True
+
+        if args.playlistDirectory:
+            try:
+                count = writePlaylist(args.playlistDirectory, args.playlist,
+                                      paths)
+            except (IOError, OSError) as e:
+                log.error('Unable to write playlist: %s', e)
+                return False
+
+            if not count:
+                log.error("No tracks found for queries.")
+                return False
+
+            log.info("New playlist: %s tracks", count)
+            return True
+
+        target = ('playlist "%s"' % args.playlist if args.playlist
+                  else 'queue')
+        count, errors = streamPaths(queueDaemons, paths,
+                                    earlyStart=args.earlyStart,
+                                    playlist=args.playlist)
+        if not count:
+            log.error("No tracks found for queries.")
+            return False
 
-    for queryType in queries:
-        if getattr(args, queryType):
-            for query in getattr(args, queryType):
-                pools.append(Playlist(
-                    *[Track(duration=track['time'],  # Unpack listcomp of Tracks
-                            path=track['file'].replace('file: ', ''))  # Trim file string
-                      for track in daemon.search(queryType, query)]))
+        failed = False
+        for queueDaemon, error in zip(queueDaemons, errors):
+            if error is not None:
+                failed = True
+                log.error('Unable to update the %s of %s: %s',
+                          target, queueDaemon.address, error)
+
+            if len(queueDaemons) > 1:
+                print '%s: %s' % (queueDaemon.address,
+                                  'failed' if error else 'OK')
+
+        log.info("New playlist: %s tracks", count)
+
+        return not failed
+
+    if songs is not None:
+        if args.stream:
+            # Keep only a random sample of the tracks to pick from
+            songs = randomSample(((path, duration)
+                                  for path, duration in songs
+                                  if duration > 0),
+                                 STREAM_SAMPLE_SIZE)
+
+        pools = [Playlist(store, tracksFromSongs(store, songs))]
 
     # Check result
     if not any(pools):
@@ -290,28 +1100,26 @@ def main():
 
     log.debug("Pool: %s tracks, %s seconds" % (
         sum(map(len, pools)),
-        sum([track.duration
-             for pool in pools
-             for track in pool
-             if track.duration > 0])))
+        sum(store.durations[trackId]
+            for pool in pools
+            for trackId in pool
+            if store.durations[trackId] > 0)))
 
     # Build new playlist without dupes
+    tracer.phase('dedup')
 
     # Test the track duration. I found one track that had a very
     # strange duration, a huge negative number, and it messed up the
     # script and caused an infinite loop.
-    originalPool = Playlist(
-        *set([Track(duration=track.duration,  # Unpack the set
-                    path=track.path)
-              for pool in pools
-              for track in pool
-              if track.duration > 0]))
-    newPlaylist = Playlist()
-    numInputTracks = len(originalPool)
-
-    pool = Playlist(*originalPool)
+    pool = Playlist(store, sorted(set(trackId
+                                      for pool in pools
+                                      for trackId in pool
+                                      if store.durations[trackId] > 0)))
+    newPlaylist = Playlist(store)
+    numInputTracks = len(pool)
 
     # *** Using duration
+    tracer.phase('fill')
     if args.duration:
 
         # Convert duration from minutes to seconds
@@ -324,92 +1132,135 @@ def main():
             log.debug('Track pool duration (%s seconds) shorter than desired duration (%s seconds);'
                       'will allow duplicate tracks in output',
                       pool.duration, args.duration)
-            newPlaylist = Playlist(*pool)  # Start with all the tracks
+            newPlaylist = Playlist(store, pool)  # Start with all the tracks
 
         else:
             allowDuplicates = False
             log.debug('Not allowing duplicate tracks in output')
 
-        tries = 1
-        while True:
-            remainingTime = args.duration - newPlaylist.duration
-
-            # Isn't there some way to do this in the while condition in Python?
-            tracksThatFit = [Track(duration=track.duration, path=track.path)
-                             for track in pool
-                             if int(track.duration) < remainingTime]
-
-            log.debug("Tracks that fit in remaining time of %s seconds: %s",
-                      remainingTime, len(tracksThatFit))
-
-            # Are we there yet?
-            if not tracksThatFit:
-                log.debug("No tracks remaining that fit in remaining time of %s seconds",
-                          remainingTime)
-
-                if (args.duration - newPlaylist.duration > 30):
-                    # If not within 30 seconds of desired time, start over
-
-                    # TODO: Increase margin gradually. This will help
-                    # prevent situations where, e.g. the desired
-                    # duration is 25 minutes, but the closest it can get
-                    # is 24 minutes, and after the 10 tries, it
-                    # happens to go with one that's only 21 minutes
-                    # long instead of 24.
-                    if tries == len(originalPool):
-                        log.warning("Tried %s times to make a playlist within 30 seconds"
-                                    "of the desired duration; gave up and made one %s seconds long.",
-                                    tries, newPlaylist.duration)
-                        break
+        if args.solver == 'exact':
+            # Repeat the whole pool as many times as it fits, then
+            # fill the rest with the subset of it that comes closest
+            copies = (args.duration // pool.duration
+                      if allowDuplicates else 0)
 
-                    log.debug("Not within 30 seconds of desired playlist duration.  Trying again...")
+            # Shuffle so that equally good subsets are picked randomly
+            tracks = list(pool)
+            random.shuffle(tracks)
 
-                    if not allowDuplicates:
-                        pool = Playlist()
-                        pool.extend(originalPool)
-                        newPlaylist = Playlist()
-                    else:
-                        # Add all tracks to playlist
-                        newPlaylist = Playlist(*pool)
+            chosen = subsetSum([store.durations[i] for i in tracks],
+                               args.duration - copies * pool.duration,
+                               timeBudget=args.timeBudget)
+            newPlaylist = Playlist(store, (list(pool) * copies
+                                          + [tracks[i] for i in chosen]))
 
-                    tries += 1
+            if args.duration - newPlaylist.duration > 30:
+                log.warning("Can't make a playlist within 30 seconds of the "
+                            "desired duration; the closest possible is "
+                            "%s seconds long.", newPlaylist.duration)
 
-                # We are there yet.
-                else:
-                    log.debug("Took %s tries to make playlist" % tries)
+        else:
+            index = TrackIndex(store, pool)
 
-                    break
+            tries = 1
+            while True:
+                remainingTime = args.duration - newPlaylist.duration
 
-            # Keep going
-            else:
-                newTrack = random.choice(tracksThatFit)
-                newPlaylist.append(newTrack)
-                log.debug("Adding track: %s" % newTrack)
-                if not allowDuplicates:
-                    pool.remove(newTrack)
+                numTracksThatFit = index.count(remainingTime)
+
+                log.debug("Tracks that fit in remaining time of %s seconds: %s",
+                          remainingTime, numTracksThatFit)
+
+                # Are we there yet?
+                if not numTracksThatFit:
+                    log.debug("No tracks remaining that fit in remaining time of %s seconds",
+                              remainingTime)
+
+                    if (args.duration - newPlaylist.duration > 30):
+                        # If not within 30 seconds of desired time, start over
+
+                        # TODO: Increase margin gradually. This will help
+                        # prevent situations where, e.g. the desired
+                        # duration is 25 minutes, but the closest it can get
+                        # is 24 minutes, and after the 10 tries, it
+                        # happens to go with one that's only 21 minutes
+                        # long instead of 24.
+                        if tries == numInputTracks:
+                            log.warning("Tried %s times to make a playlist within 30 seconds"
+                                        "of the desired duration; gave up and made one %s seconds long.",
+                                        tries, newPlaylist.duration)
+                            break
+
+                        log.debug("Not within 30 seconds of desired playlist duration.  Trying again...")
+
+                        if not allowDuplicates:
+                            index.restore()
+                            newPlaylist = Playlist(store)
+                        else:
+                            # Add all tracks to playlist
+                            newPlaylist = Playlist(store, pool)
+
+                        tries += 1
+
+                    # We are there yet.
+                    else:
+                        log.debug("Took %s tries to make playlist" % tries)
+
+                        break
+
+                # Keep going
+                else:
+                    newTrack = index.pick(remainingTime,
+                                          remove=not allowDuplicates)
+                    newPlaylist.append(newTrack)
+                    log.debug("Adding track: %s", store.name(newTrack))
 
     else:
         # *** No duration; use all tracks
-        newPlaylist = Playlist(*pool)
+        newPlaylist = Playlist(store, pool)
 
         # TODO: Shuffle it since it doesn't get created randomly
 
     # *** Add tracks to mpd or print
+    tracer.phase('queue')
+    failed = False
     if args.printFilenames:
         # Just print filenames to STDOUT
-        print "\n".join([track.path for track in newPlaylist])
+        print "\n".join(newPlaylist.paths())
 
-    else:
-        # Add tracks to MPD
-        daemon.clear()
+    elif args.playlistDirectory:
+        # Write the playlist where the daemons will find it
+        try:
+            writePlaylist(args.playlistDirectory, args.playlist,
+                          newPlaylist.paths())
+        except (IOError, OSError) as e:
+            failed = True
+            log.error('Unable to write playlist: %s', e)
 
-        daemon.command_list_ok_begin()
-        for track in newPlaylist:
-            daemon.add(track.path)
+    else:
+        # Add tracks to MPD, on all the servers at once
+        paths = newPlaylist.paths()
+        target = ('playlist "%s"' % args.playlist if args.playlist
+                  else 'queue')
+
+        def apply(daemon):
+            daemon.connect()
+            if args.playlist:
+                savePlaylist(daemon, args.playlist, paths)
+            else:
+                applyPlaylist(daemon, paths, update=args.update,
+                              earlyStart=args.earlyStart)
 
-        daemon.command_list_end()
+        for queueDaemon, (result, error) in zip(
+                servers, parallel(apply, servers)):
+            if error is not None:
+                failed = True
+                log.error('Unable to update the %s of %s: %s',
+                          target, queueDaemon.address, error)
 
-        daemon.play()
+            if len(servers) > 1:
+                print '%s: %s' % (queueDaemon.address,
+                                  'failed' if error else 'OK')
 
         # TODO: Send these to STDERR so they can be used with -p
         # without interfering
@@ -427,8 +1278,362 @@ def main():
             log.info("New playlist: %s tracks, %ih:%im:%is",
                      numInputTracks, hours, minutes, seconds)
 
-    return True
+    return not failed
+
+
+def randomSample(items, size):
+    '''Returns a random sample of up to size of the items from an
+    iterable, reading it once and never keeping more than size of
+    them (reservoir sampling).'''
+
+    sample = []
+    for count, item in enumerate(items):
+        if count < size:
+            sample.append(item)
+        else:
+            i = random.randint(0, count)
+            if i < size:
+                sample[i] = item
+
+    return sample
+
+
+def runCommands(daemon, commands):
+    '''Sends (command, args) tuples to the daemon in batched command
+    lists.'''
+
+    for i in xrange(0, len(commands), ADD_BATCH_SIZE):
+        daemon.command_list_ok_begin()
+        for command, args in commands[i:i + ADD_BATCH_SIZE]:
+            getattr(daemon, command)(*args)
+        daemon.command_list_end()
+
+
+def savePlaylist(daemon, name, paths):
+    '''Replaces the daemon's stored playlist name with paths, creating it
+    if necessary, without touching the queue.'''
+
+    daemon.playlistclear(name)
+    addPaths(daemon, paths, playlist=name)
+
+
+def searchSongs(daemon, searches, cache=None):
+    '''Returns a list of the (path, duration) of each song found by each
+    tuple of search arguments in searches, asking the daemon for them
+    all in one command list.  With a cache dict, only the searches
+    that aren't in it are sent, and their results are added to it.'''
+
+    if cache is None:
+        cache = {}
+
+    keys = [(daemon.address,) + tuple(search) for search in searches]
+    missing = [search for search, key in zip(searches, keys)
+               if key not in cache]
+
+    if missing:
+        daemon.command_list_ok_begin()
+        for search in missing:
+            daemon.songFields(['file', 'time'], 'search', *search)
+
+        for search, songs in zip(missing, daemon.command_list_end()):
+            cache[(daemon.address,) + tuple(search)] = songs
+
+    return [cache[key] for key in keys]
+
+
+def streamPaths(daemons, paths, earlyStart=False, playlist=None):
+    '''Replaces the queues of daemons with paths and plays them, reading
+    paths one batch at a time, so only one batch is ever in memory.
+    Playing starts after the first batch with earlyStart, otherwise
+    after the last.  With playlist, the daemons' stored playlists of
+    that name are replaced instead, and nothing is played.  The
+    daemons are left alone if there are no paths.  Returns the number
+    of paths and a list of the exception that stopped each daemon, or
+    None.'''
+
+    errors = dict((daemon, None) for daemon in daemons)
+
+    def step(function):
+        working = [daemon for daemon in daemons if errors[daemon] is None]
+        for daemon, (result, error) in zip(working,
+                                           parallel(function, working)):
+            if error is not None:
+                errors[daemon] = error
+
+    def start(daemon):
+        daemon.connect()
+        if playlist is None:
+            daemon.clear()
+        else:
+            daemon.playlistclear(playlist)
+
+    paths = iter(paths)
+    batch = list(itertools.islice(paths, ADD_BATCH_SIZE))
+    if not batch:
+        return 0, [None] * len(daemons)
+
+    step(start)
+
+    count = 0
+    playing = False
+    while batch:
+        step(lambda daemon: addPaths(daemon, batch, playlist))
+        count += len(batch)
+
+        if earlyStart and not playing and playlist is None:
+            step(lambda daemon: daemon.play())
+            playing = True
+
+        batch = list(itertools.islice(paths, ADD_BATCH_SIZE))
+
+    if not playing and playlist is None:
+        step(lambda daemon: daemon.play())
+
+    return count, [errors[daemon] for daemon in daemons]
+
+
+def tracksFromSongs(store, songs):
+    '''Adds the (path, duration) of each song from the daemon to store
+    and returns a list of their track IDs.  Durations are rounded to
+    whole seconds.'''
+
+    return [store.add(path, int(round(duration or 0)))
+            for path, duration in songs]
+
+
+def writePlaylist(directory, name, paths):
+    '''Writes paths to name.m3u in directory, which should be MPD's
+    playlist_directory, where the daemon finds it as the stored
+    playlist name.  Returns the number of paths, which can be any
+    iterable.  The file is left alone if there are no paths.'''
+
+    checkPlaylistName(name)
+
+    paths = iter(paths)
+    first = next(paths, None)
+    if first is None:
+        return 0
+
+    def write(f):
+        count = 0
+        for track in itertools.chain([first], paths):
+            f.write(track + '\n')
+            count += 1
+
+        return count
+
+    return writeAtomically(os.path.join(directory, name + '.m3u'), write)
+
+
+def main():
+
+    # *** Parse args
+    parser = argparse.ArgumentParser(
+        description='Search for tracks in an MPD library and '
+        'add them to its playlist')
+
+    # TODO: parse any number, with or without 'm' or 'h' at the end,
+    # as length in minutes or hours
+    parser.add_argument('-d', '--duration', metavar="MINUTES",
+                        help="Desired duration of queue in minutes")
+    parser.add_argument('-S', '--solver', choices=['exact', 'random'],
+                        default='exact',
+                        help='How to pick tracks for a duration: "exact" '
+                        'finds the closest possible playlist in one pass; '
+                        '"random" picks tracks randomly and starts over '
+                        'if it misses.  Default: exact')
+    parser.add_argument('--time-budget', metavar='SECONDS', dest='timeBudget',
+                        type=float, default=5,
+                        help='Maximum time for the exact solver to search '
+                        'before settling for the best playlist found so '
+                        'far.  Default: 5')
+    parser.add_argument('-s', '--server', dest='hosts', metavar='HOST',
+                        action='append',
+                        help='Name or address of server, optionally with '
+                        'port and password in PASSWORD@HOST:PORT format, '
+                        'or the path of its Unix socket.  Give more than '
+                        'once to send the playlist to several servers; the '
+                        'first one is searched.  Default: $MPD_HOST and '
+                        '$MPD_PORT, or localhost:6600')
+
+    # TODO: Use action='append' and flatten resulting lists
+    parser.add_argument('-A', '--any', nargs='*')
+    parser.add_argument('-a', '--artists', dest='artist', nargs='*')
+    parser.add_argument('-b', '--albums', dest='album', nargs='*')
+    parser.add_argument('-t', '--titles', dest='title', nargs='*')
+    parser.add_argument('-g', '--genres', dest='genre', nargs='*')
+    parser.add_argument('--all', dest='matchAll', action='store_true',
+                        help='Find tracks matching every query instead of '
+                        'any of them.  Either way, queries starting with '
+                        '"!" exclude the tracks they match')
+
+    parser.add_argument('-L', '--library-cache', metavar='PATH',
+                        dest='libraryCache',
+                        help='Answer queries from a snapshot of the library '
+                        'stored in PATH, which is rebuilt when the '
+                        "server's database changes.  The snapshot only has "
+                        'the artist, album, title, genre and file of each '
+                        'track, so --any may find fewer tracks than MPD '
+                        'would')
+    parser.add_argument('-Q', '--query-cache', metavar='PATH',
+                        dest='queryCache',
+                        help='Store the results of searches in PATH and '
+                        'reuse them until the server\'s database changes')
+    parser.add_argument('--query-cache-size', metavar='TRACKS', type=int,
+                        dest='queryCacheSize', default=QUERY_CACHE_SIZE,
+                        help='Drop the least recently used results when the '
+                        'query cache holds more than this many tracks.  '
+                        'Default: %d' % QUERY_CACHE_SIZE)
+
+    parser.add_argument('-p', '--print-filenames',
+                        dest='printFilenames', action="store_true")
+    queueMode = parser.add_mutually_exclusive_group()
+    queueMode.add_argument('-e', '--early-start', dest='earlyStart',
+                           action='store_true',
+                           help='Start playing as soon as the first few '
+                           'tracks are queued, and add the rest while they '
+                           'play')
+    queueMode.add_argument('-u', '--update', action='store_true',
+                           help='Change the existing queue into the new '
+                           'playlist with as few commands as possible, '
+                           'without interrupting the current song')
+
+    parser.add_argument('-P', '--playlist', metavar='NAME',
+                        help='Save the tracks as the stored playlist NAME, '
+                        'replacing it, instead of changing the queue')
+    parser.add_argument('--playlist-directory', metavar='DIR',
+                        dest='playlistDirectory',
+                        help="Write the --playlist as NAME.m3u in DIR, "
+                        "MPD's playlist_directory, instead of sending it "
+                        'to the server')
+    parser.add_argument('--stream', action='store_true',
+                        help='Use search results as they arrive instead of '
+                        'all at once.  Without a duration, they are added '
+                        'to the queue in batches; with one, the playlist is '
+                        'made from a random sample of %d of them.'
+                        % STREAM_SAMPLE_SIZE)
+
+    parser.add_argument('-J', '--jobs', metavar='PATH',
+                        help='Make a playlist for each line of PATH, or of '
+                        'standard input if PATH is "-", in one run.  Each '
+                        'line is a JSON object of long options and their '
+                        'values, like {"genres": ["rock"], "duration": 60, '
+                        '"server": "kitchen"}; options on the command line '
+                        'apply to every job that doesn\'t set them.  '
+                        'Connections, library snapshots and search results '
+                        'are shared by the jobs')
+
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Append a trace of the time, CPU time, MPD '
+                        'commands and memory growth of each phase of the '
+                        'run to PATH, as JSON lines')
+    parser.add_argument('--cprofile', metavar='PATH',
+                        help='Write cProfile statistics of the run to PATH')
+    parser.add_argument('--stats-file', metavar='PATH', dest='statsFile',
+                        help='At exit, write the count, latency histogram '
+                        'and bytes of each command sent to the server to '
+                        'PATH, as a Prometheus textfile if PATH ends in '
+                        '".prom", otherwise as JSON')
+    parser.add_argument("-v", "--verbose", action="count", dest="verbose",
+                        help="Be verbose, up to -vvv")
+    args = parser.parse_args()
+
+    # *** Setup logging
+    log = logging.getLogger('trim-mpd-queue')
+    if args.verbose >= 3:
+        # Debug everything, including MPD module.  This sets the root
+        # logger, which python-mpd2 uses.  Too bad it doesn't use a
+        # logging.NullHandler to make this cleaner.  See
+        # https://docs.python.org/2/howto/logging.html#library-config
+        LOG_LEVEL = logging.DEBUG
+        logging.basicConfig(level=LOG_LEVEL,
+                            format="%(levelname)s: %(name)s: %(message)s")
+
+    else:
+        # Don't debug MPD.  Don't set the root logger.  Do manually
+        # what basicConfig() does, because basicConfig() sets the root
+        # logger.  This seems more confusing than it should be.  I
+        # think the key is that logging.logger.getChild() is not in
+        # the logging howto tutorials.  When I found getChild() (which
+        # is in the API docs, which are also not obviously linked in
+        # the howto), it started falling into place.  But without
+        # getchild(), it was a confusing mess.
+        if args.verbose == 1:
+            LOG_LEVEL = logging.INFO
+        elif args.verbose == 2:
+            LOG_LEVEL = logging.DEBUG
+        else:
+            LOG_LEVEL = logging.WARNING
+
+        handler = logging.StreamHandler()
+        handler.setFormatter(
+            logging.Formatter("%(levelname)s: %(name)s: %(message)s"))
+        log.addHandler(handler)
+        log.setLevel(LOG_LEVEL)
+
+    log.debug('Using python-mpd version: %s', str(mpd.VERSION))
+    log.debug("Args: %s", args)
+
+    # *** Setup tracing
+    tracer = PhaseTracer('mpd-search-add', args.profile, args.cprofile)
+    atexit.register(tracer.finish)
+
+    # Every Client used, for tracing and statistics
+    daemons = []
+    tracer.daemons = daemons
+
+    if args.statsFile:
+        atexit.register(writeCommandStats, args.statsFile, daemons, log)
+
+    # *** Run jobs
+    if not args.jobs:
+        return makePlaylist(args, log, tracer, daemons)
+
+    cache = JobCache()
+    failed = 0
+    try:
+        jobs = sys.stdin if args.jobs == '-' else open(args.jobs)
+    except IOError as e:
+        log.error('Unable to read jobs: %s', e)
+        return False
+
+    for number, line in enumerate(jobs, 1):
+        if not line.strip():
+            continue
+
+        # Options from the command line apply unless the job sets them
+        try:
+            job = json.loads(line)
+            jobArgs = argparse.Namespace(**vars(args))
+            if 'server' in job:
+                jobArgs.hosts = None
+            parser.parse_args(jobArguments(parser, job), namespace=jobArgs)
+
+            # The parser only sees the job's own options, so check
+            # those that conflict with the command line's again
+            if jobArgs.earlyStart and jobArgs.update:
+                parser.error('argument -u/--update: not allowed with '
+                             'argument -e/--early-start')
+        except (ValueError, SystemExit) as e:
+            log.error('Invalid job on line %s: %s', number, line.strip())
+            failed += 1
+            continue
+
+        log.info('Running job on line %s', number)
+        tracer.job = number
+        try:
+            succeeded = makePlaylist(jobArgs, log, tracer, daemons, cache)
+        except Exception as e:
+            log.exception('Job on line %s failed: %s', number, e)
+            succeeded = False
+
+        if not succeeded:
+            failed += 1
+
+    if failed:
+        log.error('%s jobs failed', failed)
 
+    return not failed
 
 if __name__ == '__main__':
     sys.exit(0 if main() else 1)
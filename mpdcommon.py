@@ -0,0 +1,706 @@
+# * mpdcommon.py
+
+# Code shared by mpd-search-add.py and trim-mpd-playlist.py: a base
+# class for their MPD clients, command statistics, phase tracing, and
+# a few helper functions.  Keep this file next to the scripts.
+
+# ** Imports
+import bisect
+import collections
+import cProfile
+import cPickle as pickle
+import json
+from multiprocessing.pool import ThreadPool
+import os
+import resource
+import socket
+import time
+
+import mpd  # Using python-mpd2
+
+# ** Constants
+DEFAULT_PORT = 6600
+
+# ** Classes
+
+
+class CommandStats(object):
+    '''Counts the commands sent to one daemon, and records their
+    latencies in histograms and the bytes sent and received.'''
+
+    # Upper bounds of the latency histogram buckets, in seconds
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+               0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self, server):
+        self.server = server
+        self.commands = {}
+
+    def record(self, command, seconds, bytesSent, bytesReceived,
+               error=False):
+        '''Records one response to command.'''
+
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = {
+                'count': 0, 'errors': 0, 'seconds': 0.0, 'bytesSent': 0,
+                'bytesReceived': 0, 'buckets': [0] * len(self.buckets)}
+
+        stats['count'] += 1
+        stats['errors'] += error
+        stats['seconds'] += seconds
+        stats['bytesSent'] += bytesSent
+        stats['bytesReceived'] += bytesReceived
+        stats['buckets'][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def cumulativeBuckets(self, command):
+        '''Returns a list of (upper bound, count) for command, counting
+        each response in every bucket it fits, like Prometheus.'''
+
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets,
+                                self.commands[command]['buckets']):
+            total += count
+            result.append(('+Inf' if bound == float('inf') else repr(bound),
+                           total))
+
+        return result
+
+    def toDict(self):
+        '''Returns the statistics as a dict for JSON.'''
+
+        return {'server': self.server,
+                'commands': dict(
+                    (command, dict(stats, buckets=dict(
+                        self.cumulativeBuckets(command))))
+                    for command, stats in self.commands.iteritems())}
+
+    def totals(self):
+        '''Returns a dict of the count, seconds and bytes of all
+        commands.'''
+
+        keys = ['count', 'seconds', 'bytesSent', 'bytesReceived']
+
+        return dict((key, sum(stats[key]
+                              for stats in self.commands.itervalues()))
+                    for key in keys)
+
+
+class PhaseTracer(object):
+    '''Records the wall time, CPU time, MPD commands and memory use of
+    each phase of a run, and appends them to a file as JSON lines.
+    Phases follow one another: starting one ends the last.  Phases
+    started while job is set are recorded with it.'''
+
+    def __init__(self, script, path=None, profilePath=None):
+        self.script = script
+        self.path = path
+        self.profilePath = profilePath
+
+        # Clients whose commands to count
+        self.daemons = []
+
+        # Line number of the --jobs job being run
+        self.job = None
+
+        self.records = []
+        self.current = None
+        self.first = self._sample()
+
+        if profilePath:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.profiler = None
+
+    def finish(self):
+        '''Ends the last phase, and writes the trace and the profile.'''
+
+        if self.profiler:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profilePath)
+
+        if not self.path:
+            return
+
+        last = self._sample()
+        if self.current:
+            self._record(*self.current + (last,))
+        self._record('total', None, self.first, last)
+
+        with open(self.path, 'a') as f:
+            for record in self.records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def phase(self, name):
+        '''Ends the current phase, if any, and starts phase name.'''
+
+        if not self.path:
+            return
+
+        sample = self._sample()
+        if self.current:
+            self._record(*self.current + (sample,))
+        self.current = (name, self.job, sample)
+
+    def _record(self, name, job, start, end):
+        record = {'script': self.script,
+                  'pid': os.getpid(),
+                  'run': self.first['time'],
+                  'phase': name,
+                  'start': start['time'],
+                  'seconds': end['time'] - start['time'],
+                  'rssKiB': end['rssKiB'],
+                  'maxRSSGrowthKiB': end['maxRSSKiB'] - start['maxRSSKiB']}
+
+        if job is not None:
+            record['job'] = job
+
+        for key in ['cpuSeconds', 'commands', 'commandSeconds', 'bytesSent',
+                    'bytesReceived']:
+            record[key] = end[key] - start[key]
+
+        self.records.append(record)
+
+    def _sample(self):
+        times = os.times()
+        sample = {'time': time.time(),
+                  'cpuSeconds': times[0] + times[1],
+                  'maxRSSKiB': resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss,
+                  'rssKiB': None,
+                  'commands': 0, 'commandSeconds': 0.0, 'bytesSent': 0,
+                  'bytesReceived': 0}
+
+        try:
+            with open('/proc/self/statm') as f:
+                sample['rssKiB'] = (int(f.read().split()[1])
+                                    * resource.getpagesize() // 1024)
+        except (IOError, OSError):
+            pass
+
+        for daemon in self.daemons:
+            totals = daemon.commandStats.totals()
+            sample['commands'] += totals['count']
+            sample['commandSeconds'] += totals['seconds']
+            sample['bytesSent'] += totals['bytesSent']
+            sample['bytesReceived'] += totals['bytesReceived']
+
+        return sample
+
+
+class BaseClient(mpd.MPDClient):
+    '''Subclasses mpd.MPDClient with what both scripts' Clients need:
+    parsing server addresses, sharing and reconnecting connections,
+    reading only some fields of songs, and recording statistics of
+    every command.'''
+
+    initAttrs = {None: ['currentStatus', 'lastSong',
+                        'currentSongFiletype', 'playlist',
+                        'playlistVersion', 'playlistLength',
+                        'song', 'duration', 'elapsed', 'state',
+                        'hasBeenSynced', 'playing', 'paused'],
+                 False: ['consume', 'random', 'repeat',
+                         'single']}
+
+    # Clients made by shared(), by class and address, so each script
+    # gets its own kind of Client
+    _shared = {}
+
+    def __init__(self, host, port=DEFAULT_PORT, password=None, latency=None,
+                 logger=None):
+
+        super(BaseClient, self).__init__()
+
+        # Command timeout
+        self.timeout = 10
+
+        self.host, self.port, self.password, hostLatency = (
+            self.parseAddress(host, port, password))
+
+        if hostLatency is not None:
+            latency = hostLatency
+
+        if latency is not None:
+            self.latency = float(latency)
+        else:
+            self.latency = None
+
+        self.log = logger.getChild('%s(%s)' %
+                                   (self.__class__.__name__, self.host))
+
+        # HOST:PORT or the socket path, for messages and statistics
+        self.address = (self.host if self.port is None
+                        else '%s:%s' % (self.host, self.port))
+
+        self.commandStats = CommandStats(self.address)
+
+    @classmethod
+    def parseAddress(cls, host=None, port=DEFAULT_PORT, password=None):
+        '''Returns (host, port, password, latency) for a server given as
+        [PASSWORD@]HOST[:PORT][/LATENCY] or [PASSWORD@]SOCKET, where
+        SOCKET is the path of a Unix socket.  If host is None, it and
+        the port come from MPD_HOST and MPD_PORT, as for mpc.  The port
+        of a socket is None.'''
+
+        latency = None
+
+        if host is None:
+            host = os.environ.get('MPD_HOST', 'localhost')
+            port = os.environ.get('MPD_PORT', port)
+
+        # Split password@host
+        if '@' in host:
+            password, host = host.rsplit('@', 1)
+
+        if host.startswith('/') or host.startswith('~'):
+            return os.path.expanduser(host), None, password, None
+
+        # Split host/latency
+        if '/' in host:
+            host, latency = host.split('/')
+
+        # Split host/port
+        if ':' in host:
+            host, port = host.split(':')
+
+        return host, int(port), password, latency
+
+    @classmethod
+    def shared(cls, host=None, port=DEFAULT_PORT, password=None,
+               logger=None):
+        '''Returns the Client for a server that was made earlier in this
+        process, or a new one.  Since connect() does nothing while a
+        Client is connected, every step that uses it shares one
+        authenticated connection.'''
+
+        key = (cls,) + cls.parseAddress(host, port, password)
+
+        client = cls._shared.get(key)
+        if client is None:
+            client = cls._shared[key] = cls(host, port, password,
+                                            logger=logger)
+        elif client._sock is not None:
+            # Make sure it hasn't timed out
+            client.checkConnection()
+
+        return client
+
+    def checkConnection(self):
+        '''Pings the daemon and tries to reconnect if necessary.'''
+
+        # I don't know why this is necessary, but for some reason the
+        # slave connections tend to get dropped.
+        try:
+            self.ping()
+
+        except Exception as e:
+            self.log.debug('Connection to "%s" seems to be down.  '
+                           'Trying to reconnect...', self.host)
+
+            # Try to disconnect first
+            try:
+                self.disconnect()  # Maybe this will help it reconnect
+            except Exception as e:
+                self.log.exception("Couldn't DISconnect from client %s: %s",
+                                   self.host, e)
+
+            # Try to reconnect
+            try:
+                self.connect()
+            except Exception as e:
+                self.log.critical('Unable to reconnect to "%s"', self.host)
+
+                return False
+            else:
+                self.log.debug('Reconnected to "%s"', self.host)
+
+                return True
+
+        else:
+            self.log.debug("Connection still up to %s", self.host)
+
+            return True
+
+    def connect(self):
+        '''Connects to the daemon and sets the password if necessary.'''
+
+        if self._sock is not None:
+            # Already connected
+            return
+
+        # Reset initial values
+        for val, attrs in self.initAttrs.iteritems():
+            for attr in attrs:
+                setattr(self, attr, val)
+
+        start = time.time()
+        super(BaseClient, self).connect(self.host, self.port)
+
+        if self.port is not None:
+            # Send each command as soon as it's written.  Otherwise the
+            # lines of a command list can wait on a delayed ACK.
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        self._connected(time.time() - start)
+
+        if self.password:
+            super(BaseClient, self).password(self.password)
+
+    def getPlaylist(self):
+        '''Gets the playlist from the daemon.'''
+
+        self.playlist = super(BaseClient, self).playlist()
+
+    def pause(self):
+        '''Pauses the daemon and tracks the playing state.'''
+
+        super(BaseClient, self).pause()
+        self.playing = False
+        self.paused = True
+
+    def seek(self, song, elapsed):
+        '''Seeks daemon to a position and updates local attributes for current
+        song and elapsed time.'''
+
+        self.song = song
+        self.elapsed = elapsed
+        super(BaseClient, self).seek(self.song, self.elapsed)
+
+    def songFields(self, names, command, *args):
+        '''Sends command and returns a generator of a tuple of the values
+        of names for each song in the response, like "file" and "time",
+        without making a dict of every tag of every song.  Entries
+        other than songs are only included if their kind, like
+        "directory", is in names.  Missing values are None, and repeated
+        tags are joined with newlines.  "time" is the "duration" the
+        daemon sends as a float, or else the whole seconds of "Time".
+
+        The generator has to be used up before the next command.  In a
+        command list, the tuples come from command_list_end() as a list
+        instead.'''
+
+        self._write_command(command, args)
+
+        if self._command_list is not None:
+            self._command_list.append(lambda: list(self._readFields(names)))
+        else:
+            return self._readFields(names)
+
+    def _connected(self, seconds):
+        '''Called by connect() with how long opening the connection and
+        reading the daemon's hello took, before the password is sent.'''
+
+        pass
+
+    def _finishCommand(self, error=False):
+        '''Records the oldest unanswered command, whose response was just
+        read.'''
+
+        inCommandList = self._command_list is not None
+
+        if self._inFlight:
+            command, start, bytesSent = self._inFlight.popleft()
+
+            # Pipelined responses arrive one after another, so each
+            # command's time starts no earlier than the previous response
+            now = time.time()
+            self.commandStats.record(
+                command, now - max(start, self._lastResponse), bytesSent,
+                self._bytesReceived, error)
+            self._lastResponse = now
+
+            if error and inCommandList:
+                # MPD skips the rest of the list
+                self._inFlight.clear()
+
+        self._bytesReceived = 0
+
+    def _readFields(self, names):
+        '''Yields the values of names for each song in the response being
+        read, for songFields().'''
+
+        # Response keys, as MPD capitalizes them, -> positions in names
+        positions = {}
+        for position, name in enumerate(names):
+            positions[name] = positions[name.capitalize()] = position
+        if 'time' in positions:
+            positions['duration'] = positions['time']
+        starts = ['file'] + [name for name in ['directory', 'playlist']
+                             if name in positions]
+
+        values = None
+        while True:
+            line = self._rfile.readline()
+            if not line.endswith('\n'):
+                self.disconnect()
+                raise mpd.ConnectionError('Connection lost while reading '
+                                          'line')
+            self._bytesReceived += len(line)
+
+            if line == 'OK\n' or line == 'list_OK\n':
+                self._finishCommand()
+                break
+            if line.startswith('ACK '):
+                self._finishCommand(error=True)
+                raise mpd.CommandError(line[4:].strip())
+
+            key, _, value = line[:-1].partition(': ')
+
+            if key == 'file' or key == 'directory' or key == 'playlist':
+                # A new entry
+                if values is not None:
+                    yield tuple(values)
+                values = [None] * len(names) if key in starts else None
+
+            position = positions.get(key)
+            if position is None or values is None:
+                continue
+
+            if key == 'duration':
+                values[position] = float(value)
+            elif key == 'Time':
+                if values[position] is None:
+                    values[position] = int(value)
+            elif values[position] is None:
+                values[position] = value
+            else:
+                values[position] += '\n' + value
+
+        if values is not None:
+            yield tuple(values)
+
+    def _read_line(self):
+        try:
+            line = super(BaseClient, self)._read_line()
+        except mpd.CommandError:
+            self._finishCommand(error=True)
+            raise
+
+        if line is None:
+            # list_OK or OK
+            self._bytesReceived += 8 if self._command_list is not None else 3
+            self._finishCommand()
+        else:
+            self._bytesReceived += len(line) + 1
+
+        return line
+
+    def _reset(self):
+        super(BaseClient, self)._reset()
+
+        # [command, time sent, bytes sent] for each command awaiting a
+        # response, oldest first
+        self._inFlight = collections.deque()
+        self._commandListStart = None
+        self._lastResponse = 0
+        self._bytesReceived = 0
+
+    def _write_command(self, command, args=[]):
+        start = time.time()
+        super(BaseClient, self)._write_command(command, args)
+
+        if command in ['command_list_begin', 'command_list_ok_begin']:
+            self._commandListStart = len(self._inFlight)
+        elif command == 'command_list_end':
+            # The daemon answers a command list only after its end
+            for entry in list(self._inFlight)[self._commandListStart:]:
+                entry[1] = start
+            self._commandListStart = None
+        elif command not in ['idle', 'noidle']:
+            # An idle's response comes when something changes, not
+            # when the daemon is done, so it isn't a latency; noidle is
+            # answered by the idle's response
+            self._inFlight.append([command, start, self._lineBytes])
+
+    def _write_line(self, line):
+        self._lineBytes = len(line) + 1
+        super(BaseClient, self)._write_line(line)
+
+
+# ** Functions
+
+def loadPickle(path, formatVersion):
+    '''Returns the dict that savePickle() wrote to path, or None if there
+    is no file or it was written with another formatVersion.  Errors
+    reading it are raised.'''
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        data = pickle.load(f)
+
+    if data.get('formatVersion') != formatVersion:
+        return None
+
+    return data
+
+
+def parallel(function, items):
+    '''Calls function on each item, each in its own thread, and returns
+    a list of (result, exception) in the order of items.'''
+
+    if not items:
+        return []
+
+    def call(item):
+        try:
+            return function(item), None
+        except Exception as e:
+            return None, e
+
+    pool = ThreadPool(len(items))
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.close()
+
+
+def savePickle(path, formatVersion, data):
+    '''Writes data, a dict, to path atomically, marked with
+    formatVersion for loadPickle().'''
+
+    data = dict(data, formatVersion=formatVersion)
+    writeAtomically(path,
+                    lambda f: pickle.dump(data, f, pickle.HIGHEST_PROTOCOL),
+                    mode='wb')
+
+
+def subsetSum(durations, target, timeBudget=None):
+    '''Returns a list of indexes into durations whose durations add up
+    as close to target as possible without going over.
+
+    This is a subset-sum over seconds, using a long int as a bitset
+    of reachable sums.  It stops early if target itself is reached.
+    If timeBudget seconds pass first, the remaining durations are
+    added greedily to the best sum found so far.'''
+
+    if target <= 0:
+        return []
+
+    deadline = time.time() + timeBudget if timeBudget is not None else None
+
+    mask = (1 << (target + 1)) - 1
+    reachable = 1  # Only 0 is reachable before adding anything
+
+    # For each reachable sum, the index of the duration that first
+    # reached it.  Following these back from a sum gives the
+    # durations that make it up.
+    parents = {}
+
+    end = len(durations)
+    for i, duration in enumerate(durations):
+        if deadline is not None and time.time() > deadline:
+            end = i
+            break
+
+        if duration <= 0 or duration > target:
+            continue
+
+        new = (reachable << duration) & mask & ~reachable
+        if not new:
+            continue
+
+        reachable |= new
+
+        # Record the parent of each newly reachable sum.  Searching
+        # the binary string is much faster than shifting the long.
+        bits = bin(new)[:1:-1]
+        s = bits.find('1')
+        while s != -1:
+            parents[s] = i
+            s = bits.find('1', s + 1)
+
+        if reachable >> target:
+            break
+
+    chosen = []
+    total = s = reachable.bit_length() - 1
+    while s:
+        i = parents[s]
+        chosen.append(i)
+        s -= durations[i]
+
+    # Out of time; fit in whatever else we can
+    for i in xrange(end, len(durations)):
+        if 0 < durations[i] <= target - total:
+            chosen.append(i)
+            total += durations[i]
+
+    return chosen
+
+
+def writeAtomically(path, write, mode='w'):
+    '''Calls write with a temp file open in mode, then renames the file
+    to path, so a reader never sees a partial file.  Returns what
+    write returns.'''
+
+    tempPath = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(tempPath, mode) as f:
+            result = write(f)
+        os.rename(tempPath, path)
+    except Exception:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+
+    return result
+
+
+def writeCommandStats(path, daemons, log):
+    '''Writes the command statistics of daemons to path, as a Prometheus
+    textfile if path ends in ".prom", or as JSON.'''
+
+    stats = [daemon.commandStats for daemon in daemons]
+
+    if path.endswith('.prom'):
+        lines = []
+        families = [('mpd_client_command_duration_seconds', 'histogram',
+                     'Time from sending an MPD command to its response'),
+                    ('mpd_client_command_errors_total', 'counter',
+                     'MPD commands answered with an error'),
+                    ('mpd_client_command_sent_bytes_total', 'counter',
+                     'Bytes sent in MPD commands'),
+                    ('mpd_client_command_received_bytes_total', 'counter',
+                     'Bytes received in responses to MPD commands')]
+        keys = {'errors_total': 'errors', 'sent_bytes_total': 'bytesSent',
+                'received_bytes_total': 'bytesReceived'}
+
+        for metric, metricType, description in families:
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s %s' % (metric, metricType))
+
+            for daemonStats in stats:
+                for command in sorted(daemonStats.commands):
+                    commandStats = daemonStats.commands[command]
+                    labels = 'server="%s",command="%s"' % (
+                        daemonStats.server, command)
+
+                    if metricType == 'histogram':
+                        for bound, count in daemonStats.cumulativeBuckets(
+                                command):
+                            lines.append('%s_bucket{%s,le="%s"} %d'
+                                         % (metric, labels, bound, count))
+                        lines.append('%s_sum{%s} %r'
+                                     % (metric, labels,
+                                        commandStats['seconds']))
+                        lines.append('%s_count{%s} %d'
+                                     % (metric, labels,
+                                        commandStats['count']))
+                    else:
+                        key = keys[metric[len('mpd_client_command_'):]]
+                        lines.append('%s{%s} %d' % (metric, labels,
+                                                    commandStats[key]))
+
+        output = '\n'.join(lines) + '\n'
+    else:
+        output = json.dumps([daemonStats.toDict() for daemonStats in stats],
+                            indent=2, sort_keys=True) + '\n'
+
+    try:
+        writeAtomically(path, lambda f: f.write(output))
+    except (IOError, OSError) as e:
+        log.warning('Unable to write command statistics to %s: %s', path, e)
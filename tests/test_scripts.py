@@ -0,0 +1,839 @@
+#!/usr/bin/env python
+
+# * test_scripts.py
+
+# Checks of the scripts' algorithms, mostly randomized and run against
+# the fake MPD server in bench/.  Run them from the top directory with:
+#
+#   python -m unittest discover tests
+
+# ** Imports
+import argparse
+import array
+from collections import Counter, OrderedDict
+from cStringIO import StringIO
+import imp
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, 'bench')]
+
+import fakempd
+import mpd
+import mpdcommon
+
+searchAdd = imp.load_source('mpd_search_add',
+                            os.path.join(ROOT_DIR, 'mpd-search-add.py'))
+trim = imp.load_source('trim_mpd_playlist',
+                       os.path.join(ROOT_DIR, 'trim-mpd-playlist.py'))
+
+# ** Constants
+LIBRARY_SIZE = 500
+SEARCH_ADD = os.path.join(ROOT_DIR, 'mpd-search-add.py')
+TRIM = os.path.join(ROOT_DIR, 'trim-mpd-playlist.py')
+TRIALS = 50
+
+log = logging.getLogger('test_scripts')
+log.addHandler(logging.NullHandler())
+
+# ** Classes
+
+
+class ServerTestCase(unittest.TestCase):
+    '''Runs each test against a fake server with a connected Client from
+    the script module in clientModule.'''
+
+    clientModule = searchAdd
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = fakempd.Server(tracks=LIBRARY_SIZE).start()
+        cls.daemon = cls.server.daemon
+        cls.library = cls.daemon.library
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.random = random.Random(0)
+        self.tempDir = tempfile.mkdtemp()
+
+        self.client = self.clientModule.Client(self.server.address,
+                                               logger=log)
+        self.client.connect()
+
+    def tearDown(self):
+        self.client.disconnect()
+        shutil.rmtree(self.tempDir)
+
+    def queuePaths(self):
+        '''Returns the paths in the fake server's queue.'''
+
+        return [self.library.path(index) for songId, index in
+                self.daemon.queue]
+
+    def searchPaths(self, *args):
+        '''Returns the set of paths the fake server finds for search
+        arguments.'''
+
+        return set(path for path, duration in self.client.songFields(
+            ['file', 'time'], 'search', *args))
+
+    def randomIndexes(self, maxLength, choices=40):
+        '''Returns a random list of library indexes, with duplicates.'''
+
+        return [self.random.randrange(choices)
+                for i in xrange(self.random.randint(0, maxLength))]
+
+
+class FilterSearchTest(ServerTestCase):
+
+    # (option, query type, queries) for randomTerms()
+    queries = [('-a', 'artist', ['artist 1', 'Artist 2', 'ist 3']),
+               ('-b', 'album', ['album 1', 'ALBUM 4']),
+               ('-t', 'title', ['track 1', 'k 2']),
+               ('-g', 'genre', ['rock', 'Jazz', 'hip-h', 'o'])]
+
+    def randomTerms(self):
+        '''Returns random (option, queryType, query, excluded) tuples, at
+        least one of them included.'''
+
+        terms = []
+        for i in xrange(self.random.randint(1, 4)):
+            option, queryType, queries = self.random.choice(self.queries)
+            terms.append((option, queryType, self.random.choice(queries),
+                          bool(terms) and self.random.random() < 0.3))
+
+        return terms
+
+    def test_filter_expression_matches_combined_searches(self):
+        for trial in xrange(TRIALS):
+            terms = self.randomTerms()
+            matchAll = self.random.random() < 0.5
+            included = [(queryType, query) for option, queryType, query,
+                        excluded in terms if not excluded]
+            excluded = [(queryType, query) for option, queryType, query,
+                        excluded in terms if excluded]
+
+            results = [sorted(self.library.find(path)
+                              for path in self.searchPaths(*term))
+                       for term in included + excluded]
+            expected = set(self.library.path(index) for index in
+                           searchAdd.combineResults(
+                               results[:len(included)],
+                               results[len(included):], matchAll))
+
+            expression = searchAdd.filterExpression(included, excluded,
+                                                    matchAll)
+            self.assertEqual(self.searchPaths(expression), expected,
+                             expression)
+
+    def test_quotes_are_escaped(self):
+        expression = searchAdd.filterExpression([('title', "it's \\ ok")])
+
+        self.assertEqual(expression, "(title contains 'it\\'s \\\\ ok')")
+        self.assertEqual(self.searchPaths(expression), set())
+
+    def test_each_protocol_version_finds_the_same_tracks(self):
+        # Filter expressions from 0.24, a command list of searches
+        # before that
+        for trial in xrange(10):
+            terms = self.randomTerms()
+            # Each option takes all its queries at once
+            options = {}
+            for option, queryType, query, excluded in terms:
+                options.setdefault(option, []).append(
+                    '!' + query if excluded else query)
+            arguments = sum(([option] + queries for option, queries in
+                             sorted(options.items())), [])
+
+            found = []
+            for version in ['0.20.0', '0.23.0', '0.24.0']:
+                server = fakempd.Server(tracks=LIBRARY_SIZE,
+                                        protocolVersion=version).start()
+                try:
+                    process = subprocess.Popen(
+                        [sys.executable, SEARCH_ADD, '-s', server.address,
+                         '-p'] + arguments,
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    output, errors = process.communicate()
+
+                    commands = server.daemon.commands
+                finally:
+                    server.stop()
+
+                # Finding nothing is an error, but not a failed search
+                self.assertTrue(process.returncode == 0
+                                or 'No tracks found' in errors, errors)
+                self.assertEqual(commands,
+                                 1 if version == '0.24.0' else len(terms))
+                found.append(sorted(output.splitlines()))
+
+            self.assertEqual(found[0], found[1])
+            self.assertEqual(found[1], found[2])
+
+
+class TrackIndexTest(unittest.TestCase):
+
+    def test_matches_available_tracks(self):
+        rand = random.Random(0)
+        random.seed(0)  # pick() uses the random module
+
+        for trial in xrange(50):
+            store = searchAdd.TrackStore()
+            trackIds = [store.add('track%d' % i, rand.randint(1, 20))
+                        for i in xrange(rand.randint(0, 60))]
+            index = searchAdd.TrackIndex(store, trackIds)
+            available = set(trackIds)
+
+            for step in xrange(100):
+                maxDuration = rand.randint(0, 22)
+                shorter = set(trackId for trackId in available
+                              if store.durations[trackId] < maxDuration)
+
+                self.assertEqual(index.count(maxDuration), len(shorter))
+
+                action = rand.random()
+                if action < 0.1:
+                    index.restore()
+                    available = set(trackIds)
+                else:
+                    remove = action < 0.7
+                    trackId = index.pick(maxDuration, remove=remove)
+                    if shorter:
+                        self.assertIn(trackId, shorter)
+                    else:
+                        self.assertIsNone(trackId)
+                    if remove:
+                        available.discard(trackId)
+
+    def test_every_track_can_be_picked(self):
+        random.seed(0)
+        store = searchAdd.TrackStore()
+        trackIds = [store.add('track%d' % i, i % 7 + 1) for i in xrange(30)]
+        index = searchAdd.TrackIndex(store, trackIds)
+
+        picked = set(index.pick(5, remove=False) for i in xrange(2000))
+        self.assertEqual(picked, set(trackId for trackId in trackIds
+                                     if store.durations[trackId] < 5))
+
+
+class QueryCacheTest(ServerTestCase):
+
+    def test_least_recently_used_are_dropped(self):
+        cache = searchAdd.QueryCache(os.path.join(self.tempDir, 'queries'),
+                                     size=50, logger=log)
+        expected = OrderedDict()  # Key -> number of tracks
+
+        for step in xrange(500):
+            query = str(self.random.randrange(20))
+            key = ('server', 'any', query)
+
+            if self.random.random() < 0.5:
+                result = cache.get(*key)
+                if key in expected:
+                    expected[key] = expected.pop(key)
+                    self.assertEqual(len(result[0]), expected[key])
+                else:
+                    self.assertIsNone(result)
+            else:
+                count = self.random.randint(0, 30)
+                songs = [('%s/%s' % (query, i), i + 0.4)
+                         for i in xrange(count)]
+                paths, durations = cache.put('server', 'any', query, songs)
+                self.assertEqual(paths, [path for path, duration in songs])
+                self.assertEqual(list(durations), range(count))
+
+                expected.pop(key, None)
+                expected[key] = count
+                while sum(expected.values()) > 50 and len(expected) > 1:
+                    expected.popitem(last=False)
+
+            self.assertEqual(list(cache.results), list(expected))
+            self.assertEqual(cache.tracks, sum(expected.values()))
+
+    def test_database_update_drops_results(self):
+        path = os.path.join(self.tempDir, 'queries')
+        cache = searchAdd.QueryCache(path, logger=log)
+        cache.load(self.client)
+        cache.put(self.client.address, 'genre', 'rock', [('a.mp3', 60)])
+        cache.put('elsewhere:6600', 'genre', 'rock', [('b.mp3', 60)])
+        cache.save()
+
+        cache = searchAdd.QueryCache(path, logger=log)
+        cache.load(self.client)
+        self.assertEqual(cache.get(self.client.address, 'genre', 'rock'),
+                         (['a.mp3'], array.array('l', [60])))
+
+        self.daemon.dbUpdate += 1
+        cache = searchAdd.QueryCache(path, logger=log)
+        cache.load(self.client)
+        self.assertIsNone(cache.get(self.client.address, 'genre', 'rock'))
+        self.assertIsNotNone(cache.get('elsewhere:6600', 'genre', 'rock'))
+
+
+class JobsTest(ServerTestCase):
+
+    def runJobs(self, arguments, jobs=None):
+        '''Runs mpd-search-add.py with arguments and, if given, jobs
+        written to a jobs file, and returns its exit status, output and
+        errors.'''
+
+        if jobs is not None:
+            path = os.path.join(self.tempDir, 'jobs')
+            with open(path, 'w') as f:
+                f.write(''.join(json.dumps(job) + '\n' for job in jobs))
+            arguments = arguments + ['-J', path]
+
+        process = subprocess.Popen(
+            [sys.executable, SEARCH_ADD, '-s', self.server.address]
+            + arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+
+        return process.returncode, output, errors
+
+    def test_job_arguments(self):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('-s', '--server', dest='hosts', action='append')
+        parser.add_argument('-d', '--duration')
+        parser.add_argument('-g', '--genres', nargs='*')
+        parser.add_argument('-e', '--early-start', action='store_true')
+        parser.add_argument('-u', '--update', action='store_true')
+        parser.add_argument('-J', '--jobs')
+
+        self.assertEqual(
+            searchAdd.jobArguments(parser, {
+                'genres': ['rock', u'caf\xe9'], 'duration': 60,
+                'server': ['a', 'b'], 'update': True,
+                'early-start': False}),
+            ['--duration', '60', '--genres', 'rock', 'caf\xc3\xa9',
+             '--server', 'a', '--server', 'b', '--update'])
+
+        for job in [{'nonsense': 1}, {'jobs': 'other'}, {'g': 'rock'}]:
+            self.assertRaises(ValueError, searchAdd.jobArguments, parser,
+                              job)
+
+    def test_jobs_share_command_line_options(self):
+        status, output, errors = self.runJobs(
+            ['-p', '-a', 'artist 1'], [{'genres': ['rock']}, {}])
+
+        self.assertEqual(status, 0, errors)
+        rock = self.searchPaths('genre', 'rock')
+        artist = self.searchPaths('artist', 'artist 1')
+        self.assertEqual(sorted(output.splitlines()),
+                         sorted(list(rock | artist) + list(artist)))
+
+    def test_conflicting_job_fails(self):
+        status, output, errors = self.runJobs(
+            ['-u', '-g', 'rock'], [{'early-start': True}])
+
+        self.assertEqual(status, 1)
+        self.assertIn('Invalid job on line 1', errors)
+
+    def test_missing_jobs_file_fails(self):
+        status, output, errors = self.runJobs(
+            ['-g', 'rock', '-J', os.path.join(self.tempDir, 'missing')])
+
+        self.assertEqual(status, 1)
+        self.assertIn('Unable to read jobs', errors)
+        self.assertNotIn('Traceback', errors)
+
+
+class LibrarySearchTest(ServerTestCase):
+
+    def randomQuery(self):
+        '''Returns a random piece of a random track's path or tag, in a
+        random case, or an odd query.'''
+
+        if self.random.random() < 0.1:
+            return self.random.choice(['-', 'zzz', 'k 1', '1', 'ROCK',
+                                       'hip-h', '.mp3', 'o'])
+
+        index = self.random.randrange(LIBRARY_SIZE)
+        value = self.random.choice([self.library.path(index)]
+                                   + [value for tag, value in
+                                      self.library.tags(index)])
+        start = self.random.randrange(len(value))
+        query = value[start:start + self.random.randint(1, 8)]
+
+        return query.upper() if self.random.random() < 0.3 else query
+
+    def test_matches_server(self):
+        library = searchAdd.Library(os.path.join(self.tempDir, 'library'),
+                                    logger=log)
+        library.load(self.client)
+
+        for trial in xrange(500):
+            queryType = self.random.choice(['any', 'artist', 'album',
+                                            'title', 'genre', 'file'])
+            query = self.randomQuery()
+
+            found = set(library.paths[trackId]
+                        for trackId in library.search(queryType, query))
+            self.assertEqual(found, self.searchPaths(queryType, query),
+                             (queryType, query))
+
+    def test_combine_results(self):
+        for trial in xrange(200):
+            lists = [self.randomIndexes(20) for i in
+                     xrange(self.random.randint(1, 5))]
+            included = self.random.randint(1, len(lists))
+            matchAll = self.random.random() < 0.5
+
+            expected = [index for index in xrange(40)
+                        if (all if matchAll else any)(
+                            index in indexes for indexes in lists[:included])
+                        and not any(index in indexes
+                                    for indexes in lists[included:])]
+            self.assertEqual(searchAdd.combineResults(
+                lists[:included], lists[included:], matchAll), expected)
+
+
+class LongestIncreasingTest(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        rand = random.Random(0)
+        for trial in xrange(200):
+            values = rand.sample(xrange(100), rand.randint(0, 40))
+            result = searchAdd.longestIncreasing(values)
+
+            # The result is increasing in the order of values...
+            ordered = [value for value in values if value in result]
+            self.assertEqual(ordered, sorted(ordered))
+
+            # ...and as long as the longest one, found in O(n^2)
+            lengths = []
+            for i, value in enumerate(values):
+                lengths.append(1 + max([lengths[j] for j in xrange(i)
+                                        if values[j] < value] or [0]))
+            self.assertEqual(len(result), max(lengths or [0]))
+
+
+class AveragedListTest(unittest.TestCase):
+
+    def test_matches_window(self):
+        rand = random.Random(0)
+        for length in [None, 1, 2, 5, 17]:
+            averaged = trim.AveragedList(length=length, weight=0.25)
+            values = []
+            weighted = None
+
+            for step in xrange(300):
+                if rand.random() < 0.01:
+                    averaged.clear()
+                    values = []
+                    weighted = None
+                    continue
+
+                value = rand.choice([rand.uniform(-5, 5), rand.randint(0, 3)])
+                averaged.append(value)
+                values.append(float(value))
+                weighted = (value if weighted is None
+                            else 0.25 * value + 0.75 * weighted)
+
+                window = values[-length:] if length else values
+                self.assertEqual(list(averaged), window)
+                self.assertEqual(len(averaged), len(window))
+                self.assertAlmostEqual(averaged.average,
+                                       sum(window) / len(window))
+                self.assertEqual(averaged.max, max(window))
+                self.assertEqual(averaged.min, min(window))
+                self.assertEqual(averaged.range, max(window) - min(window))
+                self.assertAlmostEqual(averaged.weightedAverage, weighted)
+
+    def test_empty(self):
+        averaged = trim.AveragedList(data=[1, 2, 3], length=2)
+        self.assertEqual(list(averaged), [2.0, 3.0])
+
+        averaged.clear()
+        self.assertEqual(list(averaged), [])
+        self.assertEqual((averaged.average, averaged.max, averaged.min,
+                          averaged.range), (0, 0, 0, 0))
+
+
+class DeleteTest(ServerTestCase):
+
+    clientModule = trim
+
+    def test_coalesce_ranges(self):
+        for trial in xrange(200):
+            positions = self.randomIndexes(30)
+            ranges = trim.coalesceRanges(positions)
+
+            covered = [position for start, end in ranges
+                       for position in xrange(start, end)]
+            self.assertEqual(sorted(covered), sorted(set(positions)))
+
+            # Highest first, and no two ranges could be merged
+            for (start, end), (nextStart, nextEnd) in zip(ranges,
+                                                          ranges[1:]):
+                self.assertGreater(start, nextEnd)
+
+    def test_delete_from_queue(self):
+        for trial in xrange(TRIALS):
+            self.daemon.setQueue(self.randomIndexes(30))
+            self.client.status()
+            version = self.client.playlistVersion
+
+            songs = trim.getQueue(self.client)
+            deleted = [song for song in songs if self.random.random() < 0.5]
+            deletedIds = set(int(song.id) for song in deleted)
+
+            if self.random.random() < 0.5:
+                # Positions are out of date, so it deletes by ID
+                self.client.addid(self.library.path(0), 0)
+
+            expected = [(songId, index) for songId, index in self.daemon.queue
+                        if songId not in deletedIds]
+            if deleted:
+                trim.deleteFromQueue(self.client, deleted, version)
+
+            self.assertEqual(self.daemon.queue, expected)
+
+
+class DiffQueueTest(ServerTestCase):
+
+    def test_update_reaches_paths(self):
+        for trial in xrange(TRIALS):
+            self.daemon.setQueue(self.randomIndexes(30))
+            paths = [self.library.path(index)
+                     for index in self.randomIndexes(30)]
+
+            current = None
+            if self.daemon.queue and self.random.random() < 0.5:
+                current = self.random.choice(self.daemon.queue)
+                self.daemon.startPlaying(current[0])
+
+            queue = list(self.client.songFields(['id', 'file'],
+                                                'playlistinfo'))
+            commands = searchAdd.diffQueue(
+                queue, paths,
+                currentId=str(current[0]) if current else None)
+            searchAdd.runCommands(self.client, commands)
+
+            expected = list(paths)
+            if current:
+                # The current song is kept, first, in place of one
+                # occurrence of its path
+                currentPath = self.library.path(current[1])
+                if currentPath in expected:
+                    expected.remove(currentPath)
+                expected.insert(0, currentPath)
+
+                self.assertEqual(self.daemon.songId, current[0])
+                self.assertEqual(self.daemon.state, 'play')
+
+            self.assertEqual(self.queuePaths(), expected)
+
+            # Every song that can be reused is, so only the difference
+            # is deleted and added
+            reused = sum((Counter(path for songId, path in queue)
+                          & Counter(expected)).values())
+            counts = Counter(command for command, args in commands)
+            self.assertEqual(counts['deleteid'], len(queue) - reused)
+            self.assertEqual(counts['addid'], len(expected) - reused)
+
+    def test_unchanged_queue_needs_no_commands(self):
+        self.daemon.setQueue(self.randomIndexes(30))
+        queue = list(self.client.songFields(['id', 'file'], 'playlistinfo'))
+
+        self.assertEqual(searchAdd.diffQueue(queue, self.queuePaths()), [])
+
+
+class QueueModelTest(ServerTestCase):
+
+    clientModule = trim
+
+    def edit(self):
+        '''Makes a few random changes to the queue through the client.'''
+
+        for i in xrange(self.random.randint(1, 5)):
+            length = len(self.daemon.queue)
+            action = self.random.choice(['add', 'addAt', 'delete', 'move',
+                                         'deleteRange'])
+
+            if action == 'add' or not length:
+                self.client.add(self.library.path(self.random.randrange(40)))
+            elif action == 'addAt':
+                self.client.addid(self.library.path(self.random.randrange(40)),
+                                  self.random.randint(0, length))
+            elif action == 'delete':
+                self.client.deleteid(self.random.choice(self.daemon.queue)[0])
+            elif action == 'move':
+                self.client.moveid(self.random.choice(self.daemon.queue)[0],
+                                   self.random.randrange(length))
+            else:
+                start = self.random.randrange(length)
+                self.client.delete((start, self.random.randint(start + 1,
+                                                               length)))
+
+    def test_incremental_updates_match_queue(self):
+        path = os.path.join(self.tempDir, 'queue')
+        self.daemon.setQueue(self.randomIndexes(30))
+        trim.QueueModel(path, logger=log).load(self.client)
+
+        for trial in xrange(TRIALS):
+            self.edit()
+
+            fetches = self.client.commandStats.commands['playlistinfo']['count']
+            songs = trim.QueueModel(path, logger=log).load(self.client)
+
+            # Brought up to date from the changes, not fetched again
+            self.assertEqual(
+                self.client.commandStats.commands['playlistinfo']['count'],
+                fetches)
+            self.assertEqual(songs, trim.getQueue(self.client))
+
+    def test_other_daemon_is_not_used(self):
+        path = os.path.join(self.tempDir, 'queue')
+        self.daemon.setQueue(self.randomIndexes(30))
+        trim.QueueModel(path, logger=log).load(self.client)
+
+        # Another daemon on the same host, with a different queue but
+        # the same playlist version and start time
+        other = fakempd.Server(tracks=LIBRARY_SIZE).start()
+        try:
+            other.daemon.setQueue(self.randomIndexes(30))
+            other.daemon.startTime = self.daemon.startTime
+            other.daemon.version = self.daemon.version
+            client = trim.Client(other.address, logger=log)
+            client.connect()
+
+            songs = trim.QueueModel(path, logger=log).load(client)
+            self.assertEqual(songs, trim.getQueue(client))
+            client.disconnect()
+        finally:
+            other.stop()
+
+
+class SubsetSumTest(unittest.TestCase):
+
+    def assertValid(self, durations, target, chosen):
+        '''Checks that chosen are distinct indexes of positive durations
+        adding up to no more than target, and returns their sum.'''
+
+        self.assertEqual(len(set(chosen)), len(chosen))
+        self.assertTrue(all(durations[i] > 0 for i in chosen))
+        total = sum(durations[i] for i in chosen)
+        self.assertLessEqual(total, target)
+
+        return total
+
+    def test_matches_brute_force(self):
+        rand = random.Random(0)
+        for trial in xrange(300):
+            durations = [rand.randint(-2, 60)
+                         for i in xrange(rand.randint(0, 12))]
+            target = rand.randint(0, 300)
+            chosen = mpdcommon.subsetSum(durations, target)
+
+            positive = [d for d in durations if d > 0]
+            best = max([sum(subset)
+                        for n in xrange(len(positive) + 1)
+                        for subset in itertools.combinations(positive, n)
+                        if sum(subset) <= target] or [0])
+            self.assertEqual(self.assertValid(durations, target, chosen),
+                             best)
+
+        self.assertEqual(mpdcommon.subsetSum([1, 2], -5), [])
+
+    def test_time_budget(self):
+        # Odd targets can't be reached with even durations, so without a
+        # budget this would try every duration
+        durations = [2 * (i % 300 + 1) for i in xrange(200000)]
+        target = 360001
+
+        start = time.time()
+        chosen = mpdcommon.subsetSum(durations, target, timeBudget=0.2)
+        elapsed = time.time() - start
+
+        self.assertLess(elapsed, 2)
+        total = self.assertValid(durations, target, chosen)
+
+        # The durations left when time ran out fill what they can
+        self.assertGreater(total, target - max(durations))
+
+        # With no time at all, it's all greedy
+        chosen = mpdcommon.subsetSum([5, 4, 3, 0, 2], 9, timeBudget=0)
+        self.assertEqual(sorted(chosen), [0, 1])
+
+
+class SyncEngineTest(ServerTestCase):
+
+    clientModule = trim
+
+    def setUp(self):
+        super(SyncEngineTest, self).setUp()
+
+        self.daemon.stop()
+        self.daemon.setQueue(xrange(20))
+        self.slaveServer = fakempd.Server(tracks=LIBRARY_SIZE).start()
+
+        # Nothing listens on a port that was just closed
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        self.deadAddress = '%s:%s' % sock.getsockname()
+        sock.close()
+
+    def tearDown(self):
+        self.slaveServer.stop()
+        super(SyncEngineTest, self).tearDown()
+
+    def sync(self, slaves):
+        '''Runs every step of a SyncEngine for slaves and returns it and
+        the skews from start().'''
+
+        engine = trim.SyncEngine(self.client, slaves, logger=log)
+        engine.connect()
+        engine.replaceQueues(self.queuePaths())
+
+        return engine, engine.start()
+
+    def test_unreachable_room_fails(self):
+        good = trim.Client(self.slaveServer.address, logger=log)
+        dead = trim.Client(self.deadAddress, logger=log)
+        engine, skews = self.sync([dead, good])
+
+        self.assertEqual([daemon for daemon, error in engine.failed], [dead])
+        self.assertEqual([slave for slave, skew in skews], [good])
+        self.assertEqual(self.slaveServer.daemon.state, 'play')
+        good.disconnect()
+
+    def test_master_that_fails_to_start_fails(self):
+        def fail():
+            raise IOError('Refusing to start')
+        self.client.command_list_ok_begin = fail
+
+        good = trim.Client(self.slaveServer.address, logger=log)
+        engine, skews = self.sync([good])
+
+        self.assertEqual([daemon for daemon, error in engine.failed],
+                         [self.client])
+        self.assertEqual([slave for slave, skew in skews], [good])
+        good.disconnect()
+
+    def test_failed_room_fails_the_run(self):
+        process = subprocess.Popen(
+            [sys.executable, TRIM, '-s', self.server.address, '--sync',
+             self.slaveServer.address, self.deadAddress, '--', '60'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, errors = process.communicate()
+
+        self.assertEqual(process.returncode, 1, errors)
+        self.assertIn('%s: failed' % self.deadAddress, output.splitlines())
+        self.assertIn(self.slaveServer.address + ': ', output)
+
+
+class PlaylistFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempDir, 'name.m3u')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_check_playlist_name(self):
+        for name in ['rock', 'a b', 'x.m3u', '..', 'caf\xc3\xa9']:
+            searchAdd.checkPlaylistName(name)
+
+        for name in ['', 'a/b', '../x', '/tmp/x', 'a\nb', 'a\rb', None]:
+            self.assertRaises(ValueError, searchAdd.checkPlaylistName, name)
+
+    def test_write_playlist(self):
+        paths = ['a/1.mp3', 'b/2.mp3']
+        count = searchAdd.writePlaylist(self.tempDir, 'name', iter(paths))
+
+        self.assertEqual(count, 2)
+        self.assertEqual(open(self.path).read().splitlines(), paths)
+        self.assertEqual(os.listdir(self.tempDir), ['name.m3u'])
+
+    def test_no_paths_leave_playlist_alone(self):
+        searchAdd.writePlaylist(self.tempDir, 'name', ['a/1.mp3'])
+
+        self.assertEqual(searchAdd.writePlaylist(self.tempDir, 'name',
+                                                 iter([])), 0)
+        self.assertEqual(open(self.path).read(), 'a/1.mp3\n')
+
+    def test_invalid_name_writes_nothing(self):
+        self.assertRaises(ValueError, searchAdd.writePlaylist,
+                          self.tempDir, '../name', ['a/1.mp3'])
+        self.assertEqual(os.listdir(self.tempDir), [])
+
+
+class ReadFieldsTest(unittest.TestCase):
+
+    response = ('file: a.mp3\n'
+                'Time: 120\n'
+                'duration: 119.500\n'
+                'Artist: A\n'
+                'Title: One\n'
+                'Artist: B\n'
+                'directory: d\n'
+                'file: b.mp3\n'
+                'duration: 59.250\n'
+                'Time: 59\n'
+                'playlist: p.m3u\n'
+                'Last-Modified: 2020-01-01T00:00:00Z\n'
+                'file: c.mp3\n'
+                'Time: 30\n'
+                'OK\n')
+
+    def readFields(self, names, response=None):
+        '''Returns the list songFields() would give for names, for a
+        response.'''
+
+        client = searchAdd.Client('localhost', logger=log)
+        client._rfile = StringIO(response or self.response)
+
+        return list(client._readFields(names))
+
+    def test_fields(self):
+        self.assertEqual(self.readFields(['file', 'time', 'artist', 'title']),
+                         [('a.mp3', 119.5, 'A\nB', 'One'),
+                          ('b.mp3', 59.25, None, None),
+                          ('c.mp3', 30, None, None)])
+
+    def test_other_entries(self):
+        self.assertEqual(self.readFields(['file', 'directory']),
+                         [('a.mp3', None), (None, 'd'), ('b.mp3', None),
+                          ('c.mp3', None)])
+        self.assertEqual(self.readFields(['playlist']),
+                         [(None,), (None,), ('p.m3u',), (None,)])
+
+    def test_empty_and_errors(self):
+        self.assertEqual(self.readFields(['file'], 'OK\n'), [])
+        self.assertRaises(mpd.CommandError, self.readFields, ['file'],
+                          'file: a.mp3\nACK [50@0] {find} No such\n')
+        self.assertRaises(mpd.ConnectionError, self.readFields, ['file'],
+                          'file: a.mp3\n')
+
+
+class SharedClientTest(ServerTestCase):
+
+    def test_each_class_shares_its_own_clients(self):
+        address = self.server.address
+        searchClient = searchAdd.Client.shared(address, logger=log)
+        trimClient = trim.Client.shared(address, logger=log)
+
+        self.assertIsInstance(searchClient, searchAdd.Client)
+        self.assertIsInstance(trimClient, trim.Client)
+        self.assertIs(searchAdd.Client.shared(address, logger=log),
+                      searchClient)
+        self.assertIs(trim.Client.shared(address, logger=log), trimClient)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,23 +4,42 @@
 
 # ** Imports
 import argparse
-from collections import defaultdict
+import atexit
+from collections import Counter, defaultdict, deque, namedtuple
 import logging
 import random
-import re
+import select
 import sys
 import time
 
 import mpd  # Using python-mpd2
 
+from mpdcommon import (DEFAULT_PORT, BaseClient, PhaseTracer, loadPickle,
+                       parallel, savePickle, subsetSum, writeCommandStats)
+
 # Verify python-mpd2 is being used
 if mpd.VERSION < (0, 5, 4):
     print 'ERROR: This script requires python-mpd2 >= 0.5.4.'
     sys.exit(1)
 
 # ** Constants
-DEFAULT_PORT = 6600
-FILE_PREFIX_RE = re.compile('^file: ')
+ADD_BATCH_SIZE = 1000  # Add commands per command list
+DELETE_BATCH_SIZE = 1000  # Delete commands per command list
+
+# Commands the daemon answers without doing any real work, so their
+# times are round trip times
+RTT_COMMANDS = ['currentsong', 'password', 'ping', 'status']
+
+# Subsystems an event driven Client waits on, and those whose changes
+# make its status out of date
+IDLE_SUBSYSTEMS = ['database', 'options', 'player', 'playlist']
+STATUS_SUBSYSTEMS = set(['options', 'player', 'playlist'])
+
+# Seconds to allow for every server to receive a synced start, on top
+# of the slowest round trip, and the longest to wait for them to report
+# playing before measuring skew
+SYNC_START_MARGIN = 0.1
+SYNC_PLAY_TIMEOUT = 1
 
 # ** Classes
 class MyFloat(float):
@@ -62,106 +81,160 @@ class MyFloat(float):
     # float.  MPD doesn't support more than 3 decimal places, anyway.
     __repr__ = __str__
 
-class AveragedList(list):
+class AveragedList(object):
+    '''The most recent measurements, up to length of them, with their
+    average, max, min and range.  Measurements are kept in a ring
+    buffer with a running sum, and max and min in monotonic deques, so
+    adding one is O(1) however long the window is.  If weight is given,
+    an exponentially weighted average is kept too, with weight as the
+    smoothing factor for new measurements.'''
 
-    def __init__(self, data=None, length=None, name=None, printDebug=False):
+    def __init__(self, data=None, length=None, name=None, printDebug=False,
+                 weight=None):
         self.log = logging.getLogger(self.__class__.__name__)
 
-        # TODO: Add weighted average.  Might be better than using the range.
-
         self.name = name
         self.length = length
-        self.max = 0
-        self.min = 0
-        self.range = 0
-        self.average = 0
+        self.weight = weight
         self.printDebug = printDebug
 
-        # TODO: Isn't there a more Pythonic way to do this?
+        self.clear()
+
         if data:
-            super(AveragedList, self).__init__(data)
-            self._updateStats()
-        else:
-            super(AveragedList, self).__init__()
+            self.extend(data)
+
+    def __iter__(self):
+        '''Iterates from the oldest measurement to the newest.'''
+
+        if self.length and self._count > self.length:
+            start = self._count % self.length
+            return iter(self._values[start:] + self._values[:start])
+
+        return iter(self._values[:self._count])
+
+    def __len__(self):
+        if self.length:
+            return min(self._count, self.length)
+
+        return self._count
 
     def __str__(self):
-        return 'name:%s average:%s range:%s max:%s min:%s' % (
+        result = 'name:%s average:%s range:%s max:%s min:%s' % (
             self.name, self.average, self.range, self.max, self.min)
 
+        if self.weight is not None:
+            result += ' weightedAverage:%s' % self.weightedAverage
+
+        return result
+
     __repr__ = __str__
 
-    def append(self, arg):
-        arg = MyFloat(arg)
-        super(AveragedList, self).append(arg)
-        self._updateStats()
+    @property
+    def average(self):
+        return MyFloat(self._sum / len(self)) if self._count else 0
 
-    def clear(self):
-        '''Empties the list.'''
+    @property
+    def max(self):
+        return MyFloat(self._maxes[0][1]) if self._maxes else 0
 
-        while len(self) > 0:
-            self.pop()
+    @property
+    def min(self):
+        return MyFloat(self._mins[0][1]) if self._mins else 0
 
-    def extend(self, *args):
-        args = [[MyFloat(a) for l in args for a in l]]
-        super(AveragedList, self).extend(*args)
-        self._updateStats()
+    @property
+    def range(self):
+        return MyFloat(self.max - self.min) if self._count else 0
 
-    def insert(self, pos, *args):
-        args = [MyFloat(a) for a in args]
-        super(AveragedList, self).insert(pos, *args)
+    @property
+    def weightedAverage(self):
+        return (MyFloat(self._weightedAverage)
+                if self._weightedAverage is not None
+                else None)
+
+    def append(self, arg):
+        '''Adds a measurement, dropping the oldest one if the list is
+        full.'''
 
-        while len(self) > self.length:
-            self.pop()
-        self._updateStats()
+        value = float(arg)
+        index = self._count
 
-    def _updateStats(self):
-        self.average = MyFloat(sum(self) / len(self))
-        self.max = MyFloat(max(self))
-        self.min = MyFloat(min(self))
-        self.range = MyFloat(self.max - self.min)
+        if self.length:
+            slot = index % self.length
+            if index >= self.length:
+                self._sum -= self._values[slot]
+            self._values[slot] = value
+        else:
+            self._values.append(value)
+
+        self._sum += value
+        self._count += 1
+
+        # Drop expired measurements from the front of the deques, and
+        # ones that can never be the max or min again from the back
+        oldest = self._count - len(self)
+
+        maxes = self._maxes
+        while maxes and maxes[0][0] < oldest:
+            maxes.popleft()
+        while maxes and maxes[-1][1] <= value:
+            maxes.pop()
+        maxes.append((index, value))
+
+        mins = self._mins
+        while mins and mins[0][0] < oldest:
+            mins.popleft()
+        while mins and mins[-1][1] >= value:
+            mins.pop()
+        mins.append((index, value))
+
+        if self.weight is not None:
+            self._weightedAverage = (
+                value
+                if self._weightedAverage is None
+                else (self.weight * value
+                      + (1 - self.weight) * self._weightedAverage))
+
+        # Recompute the sum once per trip around the ring, so floating
+        # point error doesn't pile up
+        if self.length and slot == self.length - 1:
+            self._sum = sum(self._values)
 
         if self.printDebug:
             self.log.debug(self)
 
-class Client(mpd.MPDClient):
-    '''Subclasses mpd.MPDClient, keeping state data, reconnecting as
-    needed, etc.'''
-
-    initAttrs = {None: ['currentStatus', 'lastSong',
-                        'currentSongFiletype', 'playlist',
-                        'playlistVersion', 'playlistLength',
-                        'song', 'duration', 'elapsed', 'state',
-                        'hasBeenSynced', 'playing', 'paused'],
-                 False: ['consume', 'random', 'repeat',
-                         'single']}
+    def clear(self):
+        '''Empties the list.'''
 
-    def __init__(self, host, port=DEFAULT_PORT, password=None, latency=None,
-                 logger=None):
+        self._values = [0.0] * self.length if self.length else []
+        self._count = 0  # Measurements ever added
+        self._sum = 0.0
+        self._maxes = deque()  # (index, value), values decreasing
+        self._mins = deque()  # (index, value), values increasing
+        self._weightedAverage = None
 
-        super(Client, self).__init__()
+    def extend(self, values):
+        for value in values:
+            self.append(value)
 
-        # Command timeout
-        self.timeout = 10
+    def insert(self, pos, *args):
+        '''Adds measurements, like append().  They are always the
+        newest, so pos is ignored.'''
 
-        # Split host/latency
-        if '/' in host:
-            host, latency = host.split('/')
+        for arg in args:
+            self.append(arg)
 
-        if latency is not None:
-            self.latency = float(latency)
-        else:
-            self.latency = None
+class Client(BaseClient):
+    '''Subclasses BaseClient, keeping state data, reconnecting as
+    needed, etc.'''
 
-        # Split host/port
-        if ':' in host:
-            host, port = host.split(':')
+    def __init__(self, host, port=DEFAULT_PORT, password=None, latency=None,
+                 logger=None, eventDriven=False):
 
-        self.host = host
-        self.port = port
-        self.password = password
+        # Keep status up to date with idle instead of asking for it
+        # every time
+        self.eventDriven = eventDriven
 
-        self.log = logger.getChild('%s(%s)' %
-                                   (self.__class__.__name__, self.host))
+        super(Client, self).__init__(host, port, password, latency, logger)
 
         self.syncLoopLocked = False
         self.playedSinceLastPlaylistUpdate = False
@@ -171,6 +244,7 @@ class Client(mpd.MPDClient):
         self.currentSongDifferences = AveragedList(
             name='currentSongDifferences', length=10)
 
+        # Round trip times, from the times of RTT_COMMANDS
         self.pings = AveragedList(name='%s.pings' % self.host, length=10)
         self.adjustments = AveragedList(name='%sadjustments' % self.host,
                                         length=20)
@@ -189,74 +263,22 @@ class Client(mpd.MPDClient):
         # playlist in a loop and see if there is a pattern with
         # certain songs being consistently bad at syncing and seeking.
 
-    def ping(self):
-        '''Pings the daemon and records how long it took.'''
-
-        self.pings.insert(0, timeFunction(super(Client, self).ping))
-
-    def checkConnection(self):
-        '''Pings the daemon and tries to reconnect if necessary.'''
+    @property
+    def maxDifference(self):
+        '''How far apart two daemons' playing positions may be.'''
 
-        # I don't know why this is necessary, but for some reason the
-        # slave connections tend to get dropped.
-        try:
-            self.ping()
-
-        except Exception as e:
-            self.log.debug('Connection to "%s" seems to be down.  '
-                           'Trying to reconnect...', self.host)
-
-            # Try to disconnect first
-            try:
-                self.disconnect()  # Maybe this will help it reconnect
-            except Exception as e:
-                self.log.exception("Couldn't DISconnect from client %s: %s",
-                                   self.host, e)
-
-            # Try to reconnect
-            try:
-                self.connect()
-            except Exception as e:
-                self.log.critical('Unable to reconnect to "%s"', self.host)
-
-                return False
-            else:
-                self.log.debug('Reconnected to "%s"', self.host)
-
-                return True
-
-        else:
-            self.log.debug("Connection still up to %s", self.host)
-
-            return True
-
-    def connect(self):
-        '''Connects to the daemon, sets the password if necessary, and tests
-        the ping time.'''
+        return self.rtt * 5
 
-        # Reset initial values
-        for val, attrs in self.initAttrs.iteritems():
-            for attr in attrs:
-                setattr(self, attr, val)
+    @property
+    def rtt(self):
+        '''The average round trip time to the daemon.  It is measured from
+        commands sent for other reasons, so the daemon is only pinged
+        for it if there haven't been any yet.'''
 
-        super(Client, self).connect(self.host, self.port)
+        if not len(self.pings):
+            self.testPing()
 
-        if self.password:
-            super(Client, self).password(self.password)
-
-        self.testPing()
-
-    def getPlaylist(self):
-        '''Gets the playlist from the daemon.'''
-
-        self.playlist = super(Client, self).playlist()
-
-    def pause(self):
-        '''Pauses the daemon and tracks the playing state.'''
-
-        super(Client, self).pause()
-        self.playing = False
-        self.paused = True
+        return self.pings.average
 
     def play(self, initial=False):
         '''Plays the daemon, adjusting starting position as necessary.'''
@@ -280,7 +302,7 @@ class Client(mpd.MPDClient):
             else:
                 self.log.debug("Adjusting by average ping")
 
-                adjustBy = self.pings.average
+                adjustBy = self.rtt
 
             self.log.debug('Adjusting initial play by %s seconds', adjustBy)
 
@@ -288,6 +310,25 @@ class Client(mpd.MPDClient):
             # it might help avoid race conditions or something)
             self.status()
 
+            # Adjust starting position if necessary
+            # TODO: Is it necessary or good to make sure it's a
+            # positive adjustment?  There seem to be some tracks that
+            # require negative adjustments, but I don't know if that
+            # would be the case when playing from a stop
+            if adjustBy > 0:
+                # Wait for the server to...catch up?  I don't remember
+                # exactly why this code is here, because it seems like
+                # the master shouldn't be behind the slaves, but I
+                # suppose it could happen on song changes
+                deadline = time.time() + 2
+                while self.elapsed is None and time.time() < deadline:
+                    if self.eventDriven:
+                        self.waitForChange(deadline - time.time())
+                    else:
+                        time.sleep(0.2)
+                        self.status()
+                    self.log.debug(self.song)
+
             # Execute in command list
             # TODO: Is a command list necessary or helpful here?
             try:
@@ -300,24 +341,7 @@ class Client(mpd.MPDClient):
                 self.command_list_end()
                 self.command_list_ok_begin()
 
-            # Adjust starting position if necessary
-            # TODO: Is it necessary or good to make sure it's a
-            # positive adjustment?  There seem to be some tracks that
-            # require negative adjustments, but I don't know if that
-            # would be the case when playing from a stop
             if adjustBy > 0:
-                tries = 0
-
-                # Wait for the server to...catch up?  I don't remember
-                # exactly why this code is here, because it seems like
-                # the master shouldn't be behind the slaves, but I
-                # suppose it could happen on song changes
-                while self.elapsed is None and tries < 10:
-                    time.sleep(0.2)
-                    self.status()
-                    self.log.debug(self.song)
-                    tries += 1
-
                 # Seek to the adjusted playing position
                 self.seek(self.song, self.elapsed + adjustBy)
 
@@ -339,18 +363,28 @@ class Client(mpd.MPDClient):
 
         return result
 
-    def seek(self, song, elapsed):
-        '''Seeks daemon to a position and updates local attributes for current
-        song and elapsed time.'''
+    def status(self, refresh=False):
+        '''Gets daemon's status and updates local attributes.  When event
+        driven, the last status is reused until the daemon reports a
+        change, unless refresh is set.'''
 
-        self.song = song
-        self.elapsed = elapsed
-        super(Client, self).seek(self.song, self.elapsed)
+        if (self.eventDriven and self._idling and self.currentStatus
+                and not refresh):
+            if select.select([self._sock], [], [], 0)[0]:
+                self._stopIdle()
 
-    def status(self):
-        '''Gets daemon's status and updates local attributes.'''
+            if not self._changed & STATUS_SUBSYSTEMS:
+                if self.playing:
+                    self.elapsed = MyFloat(self._statusElapsed + time.time()
+                                           - self._statusTime)
+                if not self._idling:
+                    self._startIdle()
+
+                return
 
         self.currentStatus = super(Client, self).status()
+        self._statusTime = time.time()
+        self._changed.clear()
 
         # Wrap whole thing in try/except because of MPD protocol
         # errors.  But I may have fixed this by "locking" each client
@@ -364,6 +398,7 @@ class Client(mpd.MPDClient):
 
                 # Set playlist attrs
                 self.playlistLength = int(self.currentStatus['playlistlength'])
+                self.playlistVersion = int(self.currentStatus['playlist'])
                 if self.playlist:
                     self.currentSongFiletype = (
                         self.playlist[int(self.song)].split('.')[-1])
@@ -396,6 +431,10 @@ class Client(mpd.MPDClient):
                            if attr in self.currentStatus
                            else None)
                     setattr(self, attr, val)
+                self._statusElapsed = self.elapsed
+
+                if self.eventDriven:
+                    self._startIdle()
 
             else:
                 # None?  Sigh...  This shouldn't happen...if it does
@@ -416,24 +455,450 @@ class Client(mpd.MPDClient):
         # 'volume': '-1', 'single': '0'}
 
     def testPing(self):
-        '''Pings the daemon 5 times and sets the initial maxDifference.'''
+        '''Pings the daemon 5 times to measure the round trip time.'''
 
         for i in range(5):
             self.ping()
             time.sleep(0.1)
 
-        self.maxDifference = self.pings.average * 5
+        self.log.debug('Average ping for %s: %s seconds',
+                       self.host, self.pings.average)
 
-        self.log.debug('Average ping for %s: %s seconds; '
-                       'setting maxDifference: %s',
-                       self.host, self.pings.average, self.maxDifference)
+    def waitForChange(self, timeout):
+        '''Waits up to timeout seconds for the daemon to report a change
+        in IDLE_SUBSYSTEMS, and updates the status if it does.  Returns
+        True if something changed.'''
+
+        if not self._idling:
+            self.status()
+            if not self._idling:
+                self._startIdle()
+
+        if not select.select([self._sock], [], [], max(timeout, 0))[0]:
+            return False
+
+        self.status()
+
+        return True
+
+    def _connected(self, seconds):
+        # The TCP handshake and the hello take about two round trips
+        self.pings.append(seconds / 2)
+
+    def _finishCommand(self, error=False):
+        if self._inFlight:
+            command, start, bytesSent = self._inFlight[0]
+            if command in RTT_COMMANDS and start > self._lastResponse:
+                # Not queued behind another response
+                self.pings.append(time.time() - start)
+
+        super(Client, self)._finishCommand(error)
+
+    def _reset(self):
+        super(Client, self)._reset()
+
+        # Whether an idle command is waiting for changes, and the
+        # subsystems that changed since the status was last fetched
+        self._idling = False
+        self._changed = set()
+
+    def _startIdle(self):
+        # Not through send_idle(), which would make python-mpd2 refuse
+        # all other commands until fetch_idle() or noidle()
+        self._write_command('idle', IDLE_SUBSYSTEMS)
+        self._idling = True
+
+    def _stopIdle(self):
+        # If the daemon already answered the idle, it ignores noidle
+        self._idling = False
+        self._write_command('noidle')
+        for line in self._read_lines():
+            self._changed.add(line.split(': ', 1)[1])
+
+    def _write_command(self, command, args=[]):
+        if self._idling and command != 'noidle':
+            self._stopIdle()
+
+        super(Client, self)._write_command(command, args)
+
+# A song in the queue, with only what trimming needs.  Time is the
+# duration in seconds, or None for streams.
+Song = namedtuple('Song', ['pos', 'id', 'file', 'time'])
+
+class QueueModel(object):
+    '''A local copy of the daemon's queue, stored on disk.  It is brought
+    up to date with plchangesposid, so only songs that were added or
+    moved since the last run have to be transferred.'''
+
+    # Bump this when the on-disk format changes
+    formatVersion = 3
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.log = logger.getChild(self.__class__.__name__)
+
+        # HOST:PORT or socket path of the daemon, since several daemons
+        # on one host can share a path
+        self.address = None
+        self.startTime = None
+        self.version = None
+        self.songs = []
+
+    def load(self, daemon):
+        '''Updates the model from the daemon, starting from the copy on
+        disk if there is a usable one, and saves it.  Returns the list
+        of Songs.'''
+
+        daemon.status()
+        version = daemon.playlistVersion
+        length = daemon.playlistLength
+
+        known = (self._read()
+                 and self.address == daemon.address
+                 and self.version <= version)
+
+        # Playlist versions start over when the daemon restarts, so
+        # check that it's still the same daemon
+        daemon.command_list_ok_begin()
+        daemon.stats()
+        if known:
+            daemon.plchangesposid(self.version)
+        results = daemon.command_list_end()
+
+        startTime = time.time() - int(results[0]['uptime'])
+        if known and abs(startTime - self.startTime) > 5:
+            self.log.debug('Daemon has restarted since the queue was saved')
+            known = False
+
+        if not (known and self._update(daemon, results[1], length)):
+            self.log.debug('Getting whole queue')
+
+            self.songs = getQueue(daemon)
+
+        else:
+            self.songs = [song._replace(pos=str(position))
+                          for position, song in enumerate(self.songs)]
+
+        self.address = daemon.address
+        self.startTime = startTime
+        self.version = version
+        self.save()
+
+        return self.songs
+
+    def save(self):
+        '''Writes the model to disk.'''
+
+        data = {'address': self.address,
+                'startTime': self.startTime,
+                'version': self.version,
+                'songs': [tuple(song) for song in self.songs]}
+
+        try:
+            savePickle(self.path, self.formatVersion, data)
+        except (IOError, OSError) as e:
+            self.log.warning('Unable to save queue to %s: %s', self.path, e)
+
+    def _read(self):
+        '''Reads the model from disk.  Returns True if successful.'''
+
+        try:
+            data = loadPickle(self.path, self.formatVersion)
+        except Exception as e:
+            self.log.warning('Unable to read queue from %s: %s', self.path, e)
+            return False
+
+        if data is None:
+            return False
+
+        self.address = data['address']
+        self.startTime = data['startTime']
+        self.version = data['version']
+        self.songs = [Song._make(song) for song in data['songs']]
+
+        return True
+
+    def _update(self, daemon, changes, length):
+        '''Applies plchangesposid changes to the model.  Songs the model
+        doesn't know about yet are fetched by ID.  Returns False if the
+        changes don't add up to a complete queue.'''
+
+        byId = dict((song.id, song) for song in self.songs)
+
+        # Fetch new songs all at once
+        newIds = [change['id'] for change in changes
+                  if change['id'] not in byId]
+        if newIds:
+            daemon.command_list_ok_begin()
+            for songId in newIds:
+                daemon.songFields(Song._fields, 'playlistid', songId)
+            for result in daemon.command_list_end():
+                song = Song._make(result[0])
+                byId[song.id] = song
+
+        songs = self.songs[:length]
+        songs.extend([None] * (length - len(songs)))
+        for change in changes:
+            position = int(change['cpos'])
+            if position < length:
+                songs[position] = byId[change['id']]
+
+        if None in songs:
+            return False
+
+        self.log.debug('Updated queue with %s changes, %s new songs',
+                       len(changes), len(newIds))
+
+        self.songs = songs
+        return True
+
+class SyncEngine(object):
+    '''Starts slave daemons playing the master's queue in sync with it.
+    Each step talks to all the daemons at once, from a thread each, so
+    the time it takes doesn't grow with the number of rooms.'''
+
+    def __init__(self, master, slaves, logger=None):
+        self.master = master
+        self.slaves = slaves
+        self.log = logger.getChild(self.__class__.__name__)
+
+        # (daemon, exception) for each daemon that a step failed on
+        self.failed = []
+
+        # Wait for the daemons to report changes instead of polling
+        for daemon in [master] + slaves:
+            daemon.eventDriven = True
+
+    def connect(self):
+        '''Connects to the slaves, and drops those that can't be
+        reached.'''
+
+        self.slaves = self._succeeded(
+            'connect to', self.slaves,
+            parallel(lambda slave: slave.connect(), self.slaves))
+
+    def measureSkew(self):
+        '''Returns a list of (slave, skew), where skew is how many seconds
+        the slave is ahead of the master, or None if it isn't playing the
+        same song.'''
+
+        def sample(client):
+            sent = time.time()
+            client.status(refresh=True)
+            received = time.time()
+
+            # The daemon reported its position about halfway through
+            # the round trip
+            if client.elapsed is None:
+                return None, None
+            return client.song, float(client.elapsed) - (sent + received) / 2
+
+        daemons = [self.master] + self.slaves
+        samples = [result or (None, None)
+                   for result, error in parallel(sample, daemons)]
+        masterSong, masterOffset = samples[0]
+
+        skews = []
+        for slave, (song, offset) in zip(self.slaves, samples[1:]):
+            if masterSong is None or song != masterSong:
+                skews.append((slave, None))
+                continue
+
+            skew = offset - masterOffset
+            skews.append((slave, skew))
+
+            # Keep track of how far off each slave and file type is
+            slave.adjustments.append(skew)
+            if slave.playlist:
+                slave.fileTypeAdjustments[
+                    slave.playlist[int(song)].split('.')[-1]].append(skew)
+
+        return skews
+
+    def replaceQueues(self, paths):
+        '''Replaces each slave's queue with paths, and drops the slaves
+        that fail.'''
+
+        def replace(slave):
+            slave.command_list_ok_begin()
+            slave.clear()
+            for start in xrange(0, len(paths), ADD_BATCH_SIZE):
+                if start:
+                    slave.command_list_ok_begin()
+                for path in paths[start:start + ADD_BATCH_SIZE]:
+                    slave.add(path)
+                slave.command_list_end()
+            if not paths:
+                slave.command_list_end()
+
+            slave.playlist = paths
+
+        self.slaves = self._succeeded('replace the queue of', self.slaves,
+                                      parallel(replace, self.slaves))
+
+    def start(self):
+        '''Starts the slaves playing where the master is, or, if the
+        master is stopped, starts them all at the beginning of its
+        current song.  Each daemon's seek and play are sent so that they
+        all arrive at the same moment.  Daemons that fail to start are
+        added to failed, and failed slaves are dropped.'''
+
+        master = self.master
+        sent = time.time()
+        master.status(refresh=True)
+        reference = (sent + time.time()) / 2
+
+        daemons = list(self.slaves)
+        song = int(master.song or 0)
+        if master.playing:
+            position = float(master.elapsed)
+        else:
+            # Start the master too
+            position = 0.0
+            reference = None
+            daemons.insert(0, master)
+
+        startAt = (time.time() + SYNC_START_MARGIN
+                   + max(daemon.rtt for daemon in daemons))
+
+        def start(daemon):
+            # Seek ahead by the user-set latency, or by how far ahead
+            # the daemon has needed to be before
+            if daemon.latency is not None:
+                adjustBy = daemon.latency
+            else:
+                adjustBy = daemon.initialPlayTimes.average
+
+            elapsed = position + adjustBy
+            if reference is not None:
+                elapsed += startAt - reference
+
+            # Send so the commands arrive at startAt
+            delay = startAt - daemon.rtt / 2 - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            daemon.command_list_ok_begin()
+            daemon.seek(song, elapsed)
+            daemon.play()
+            daemon.command_list_end()
+
+            return adjustBy
+
+        results = parallel(start, daemons)
+        adjustments = dict((daemon, adjustBy) for daemon, (adjustBy, error)
+                           in zip(daemons, results) if error is None)
+        daemons = self._succeeded('start', daemons, results)
+        self.slaves = [slave for slave in self.slaves if slave in daemons]
+
+        # Measure as soon as every daemon that was started reports that
+        # it's playing
+        deadline = time.time() + SYNC_PLAY_TIMEOUT
+
+        def waitForPlay(daemon):
+            daemon.status()
+            while (not daemon.playing
+                   and daemon.waitForChange(deadline - time.time())):
+                pass
+
+        parallel(waitForPlay, daemons)
+
+        # Next time, seek ahead by as much as would have removed the
+        # skew
+        skews = self.measureSkew()
+        for slave, skew in skews:
+            if skew is not None:
+                slave.initialPlayTimes.append(adjustments[slave] - skew)
+
+        return skews
+
+    def _succeeded(self, action, daemons, results):
+        '''Returns the daemons whose entry in results, from parallel(),
+        has no error, and logs the others and adds them to failed.'''
+
+        succeeded = []
+        for daemon, (result, error) in zip(daemons, results):
+            if error is None:
+                succeeded.append(daemon)
+            else:
+                self.log.error('Unable to %s %s: %s', action, daemon.address,
+                               error)
+                self.failed.append((daemon, error))
+
+        return succeeded
 
 # ** Functions
-def timeFunction(f):
-    t1 = time.time()
-    f()
-    t2 = time.time()
-    return t2 - t1
+def coalesceRanges(positions):
+    '''Returns positions merged into (START, END) ranges of adjacent
+    positions, highest first, so deleting them in order doesn't shift
+    the positions of ranges not yet deleted.'''
+
+    ranges = []
+    for position in sorted(set(positions), reverse=True):
+        if ranges and ranges[-1][0] == position + 1:
+            ranges[-1][0] = position
+        else:
+            ranges.append([position, position + 1])
+
+    return [tuple(r) for r in ranges]
+
+def deleteFromQueue(daemon, songs, version):
+    '''Deletes Songs from the daemon's queue: by position if the queue
+    is still at version, otherwise by ID.'''
+
+    daemon.status()
+    if daemon.playlistVersion == version:
+        # Positions are still valid
+        deleteRanges(daemon, coalesceRanges(int(song.pos)
+                                            for song in songs))
+    else:
+        daemon.log.debug("Playlist changed; deleting songs by ID")
+
+        deleteIds(daemon, [song.id for song in songs])
+
+def deleteIds(daemon, ids):
+    '''Deletes songs by ID in batched command lists.'''
+
+    for i in xrange(0, len(ids), DELETE_BATCH_SIZE):
+        daemon.command_list_ok_begin()
+        for songId in ids[i:i + DELETE_BATCH_SIZE]:
+            daemon.deleteid(songId)
+        daemon.command_list_end()
+
+def deleteRanges(daemon, ranges):
+    '''Deletes (START, END) ranges of positions in batched command
+    lists.  Ranges should be ordered highest first, like
+    coalesceRanges() returns.'''
+
+    for i in xrange(0, len(ranges), DELETE_BATCH_SIZE):
+        daemon.command_list_ok_begin()
+        for r in ranges[i:i + DELETE_BATCH_SIZE]:
+            daemon.delete(r)
+        daemon.command_list_end()
+
+def getQueue(daemon):
+    '''Returns the daemon's queue as a list of Songs.'''
+
+    return [Song._make(values)
+            for values in daemon.songFields(Song._fields, 'playlistinfo')]
+
+def keepFiles(daemon, files):
+    '''Deletes songs from the daemon's queue so that it keeps only those
+    in files, a Counter of how many times to keep each file.'''
+
+    daemon.status()
+    version = daemon.playlistVersion
+
+    remaining = Counter(files)
+    songs = []
+    for song in getQueue(daemon):
+        if remaining[song.file] > 0:
+            remaining[song.file] -= 1
+        else:
+            songs.append(song)
+
+    if songs:
+        deleteFromQueue(daemon, songs, version)
 
 def main():
 
@@ -441,8 +906,34 @@ def main():
     parser = argparse.ArgumentParser(
             description='Trims an MPD playlist to a desired duration')
     parser.add_argument(dest='duration', help="Desired duration of playlist in minutes")
-    parser.add_argument('-s', '--server', default='localhost', dest='host',
-                        help='Name or address of server, optionally with port in HOST:PORT format.  Default: localhost:6600')
+    parser.add_argument('-s', '--server', dest='hosts', metavar='HOST', action='append',
+                        help='Name or address of server, optionally with port and password in PASSWORD@HOST:PORT '
+                        'format, or the path of its Unix socket.  Give more than once to trim several servers\' '
+                        'queues to the same songs; the songs are picked from the first one.  Default: $MPD_HOST '
+                        'and $MPD_PORT, or localhost:6600')
+    parser.add_argument('-S', '--solver', choices=['exact', 'random'], default='exact',
+                        help='How to pick songs to delete: "exact" keeps the songs closest to the desired duration; '
+                        '"random" deletes random songs and starts over if it misses.  Default: exact')
+    parser.add_argument('-b', '--time-budget', metavar='SECONDS', dest='timeBudget', type=float, default=5,
+                        help='Maximum time for the exact solver to search before settling for the best '
+                        'playlist found so far.  Default: 5')
+    parser.add_argument('-c', '--queue-cache', metavar='PATH', dest='queueCache',
+                        help='Keep a copy of the queue in PATH and only get the songs that changed since the '
+                        'last run')
+    parser.add_argument('--sync', metavar='HOST', nargs='+',
+                        help='Then copy the queue to each HOST, start them playing in sync with the server, and '
+                        'print how far ahead of it each one is')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Append a trace of the time, CPU time, MPD '
+                        'commands and memory growth of each phase of the '
+                        'run to PATH, as JSON lines')
+    parser.add_argument('--cprofile', metavar='PATH',
+                        help='Write cProfile statistics of the run to PATH')
+    parser.add_argument('--stats-file', metavar='PATH', dest='statsFile',
+                        help='At exit, write the count, latency histogram '
+                        'and bytes of each command sent to the server to '
+                        'PATH, as a Prometheus textfile if PATH ends in '
+                        '".prom", otherwise as JSON')
     parser.add_argument("-v", "--verbose", action="count", dest="verbose", help="Be verbose, up to -vvv")
     args = parser.parse_args()
 
@@ -490,8 +981,19 @@ def main():
 
     log.debug("Desired duration: %s seconds", args.duration)
 
+    # Setup tracing
+    tracer = PhaseTracer('trim-mpd-playlist', args.profile, args.cprofile)
+    atexit.register(tracer.finish)
+
     # Connect to the master server
-    daemon = Client(host=args.host, port=DEFAULT_PORT, logger=log)
+    tracer.phase('connect')
+    daemons = [Client.shared(host=host, port=DEFAULT_PORT, logger=log)
+               for host in args.hosts or [None]]
+    daemon = daemons[0]
+    tracer.daemons = daemons
+
+    if args.statsFile:
+        atexit.register(writeCommandStats, args.statsFile, daemons, log)
 
     try:
         daemon.connect()
@@ -501,47 +1003,129 @@ def main():
     else:
         log.debug('Connected to master server.')
 
-    # Get playlist
-    originalPlaylist = daemon.playlistinfo()
+    # Get playlist, after its version so we can tell if it changes
+    # before we delete by position
+    tracer.phase('playlistinfo')
+    if args.queueCache:
+        queue = QueueModel(args.queueCache, logger=log)
+        originalPlaylist = queue.load(daemon)
+        playlistVersion = queue.version
+    else:
+        daemon.status()
+        playlistVersion = daemon.playlistVersion
+        originalPlaylist = getQueue(daemon)
 
-    # Calculate length
-    originalDuration = 0
-    for song in originalPlaylist:
-        originalDuration += int(song['time'])
+    # Calculate length, in whole seconds
+    durations = dict((song, int(round(song.time or 0)))
+                     for song in originalPlaylist)
+    originalDuration = sum(durations.itervalues())
 
     log.debug("Current playlist duration: %s", originalDuration)
 
     # Reduce if needed
-    tries = 0
+    tracer.phase('solve')
     deleteSongs = []
     duration = originalDuration
-    playlist = list(originalPlaylist)
-    while duration > args.duration:
-        song = random.choice(playlist)
-        playlist.remove(song)
-        duration -= int(song['time'])
-        deleteSongs.append(song)
 
-        if (duration < args.duration
-            and abs(duration - args.duration) > 60):
-            tries += 1
-            log.debug("Tries: %s", tries)
+    if duration <= args.duration:
+        pass
 
+    elif args.solver == 'exact':
+        # Keep the songs that come closest to the desired duration and
+        # delete the rest.  Streams and other songs without a duration
+        # don't count towards it, so they are always kept.  Shuffle so
+        # that equally good sets of songs are picked randomly.
+        songs = [song for song in originalPlaylist if durations[song] > 0]
+        random.shuffle(songs)
 
-            if tries > 20:
-                log.error("Tried 5 times but playlist was too short.")
-                return False
+        keep = set(subsetSum([durations[song] for song in songs],
+                             args.duration, timeBudget=args.timeBudget))
 
-            duration = originalDuration
-            deleteSongs = []
-            playlist = list(originalPlaylist)
+        deleteSongs = [song for i, song in enumerate(songs)
+                       if i not in keep]
+        duration = originalDuration - sum(durations[song]
+                                          for song in deleteSongs)
 
-    if deleteSongs:
-        for song in deleteSongs:
-            log.debug("Deleting song: %s", song['file'])
-            daemon.deleteid(song['id'])
+    else:
+        # Deleting from the end of a shuffled list is the same as
+        # deleting random songs, without searching the list
+        tries = 0
+        playlist = list(originalPlaylist)
+        random.shuffle(playlist)
+        while duration > args.duration:
+            song = playlist.pop()
+            duration -= durations[song]
+            deleteSongs.append(song)
+
+            if (duration < args.duration
+                and abs(duration - args.duration) > 60):
+                tries += 1
+                log.debug("Tries: %s", tries)
+
+
+                if tries > 20:
+                    log.error("Tried 5 times but playlist was too short.")
+                    return False
+
+                duration = originalDuration
+                deleteSongs = []
+                playlist = list(originalPlaylist)
+                random.shuffle(playlist)
+
+    tracer.phase('queue')
+    for song in deleteSongs:
+        log.debug("Deleting song: %s", song.file)
+
+    # The other servers keep the same songs
+    files = Counter(song.file for song in originalPlaylist)
+    files.subtract(song.file for song in deleteSongs)
+
+    def trim(queueDaemon):
+        if queueDaemon is daemon:
+            if deleteSongs:
+                deleteFromQueue(daemon, deleteSongs, playlistVersion)
+        else:
+            queueDaemon.connect()
+            keepFiles(queueDaemon, files)
+
+    # Trim all the servers at once
+    failed = False
+    for queueDaemon, (result, error) in zip(daemons,
+                                            parallel(trim, daemons)):
+        if error is not None:
+            failed = True
+            log.error('Unable to trim the queue of %s: %s',
+                      queueDaemon.address, error)
+
+        if len(daemons) > 1:
+            print '%s: %s' % (queueDaemon.address,
+                              'failed' if error else 'OK')
 
     log.info('New duration: %s seconds', duration)
 
+    # Start the other servers in sync with this one
+    if args.sync:
+        tracer.phase('sync')
+        slaves = [Client.shared(host=host, logger=log) for host in args.sync]
+        daemons.extend(slave for slave in slaves if slave not in daemons)
+
+        engine = SyncEngine(daemon, slaves, logger=log)
+        engine.connect()
+        engine.replaceQueues([path for path, in daemon.songFields(
+            ['file'], 'playlistinfo')])
+
+        for slave, skew in engine.start():
+            if skew is None:
+                print '%s: not playing the same song' % slave.address
+            else:
+                print '%s: %+.1f ms' % (slave.address, skew * 1000)
+
+        for syncDaemon, error in engine.failed:
+            failed = True
+            print '%s: failed' % syncDaemon.address
+
+    if failed:
+        return False
+
 if __name__ == '__main__':
-    sys.exit(main())
+    sys.exit(1 if main() is False else 0)